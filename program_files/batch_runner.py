@@ -0,0 +1,229 @@
+"""
+Batch Runner:
+
+Runs a manifest of jobs without user input. Independent jobs run at the same time in separate worker processes, and
+the time taken and result of every job is reported. An example manifest:
+
+    workers: 4                          # Optional, defaults to one worker per job (up to the number of CPUs).
+    jobs:
+      - name: scl-ucas                  # Optional, used to name the job's output folder.
+        operation: match                # One of: match, dedupe, links, diff, changes.
+        configs: [scl.conf, ucas.conf]  # Configuration files, from the configurations folder unless a path is given.
+        inputs: [scl.csv, ucas.csv]     # Optional, defaults to the single file in each configuration's data folder.
+        mode: ucas                      # Optional (match only), 'ucas' to find schools with internal ID that now have UCAS ID.
+        incremental: yes                # Optional (match only), link only new or modified records of the second file.
+        model: path/to/cached_settings  # Optional (match and dedupe), defaults to the saved model for the configurations.
+        cores: 8                        # Optional (match and dedupe), defaults to the configuration or a share of available cores.
+        output: ./output/scl-ucas/      # Optional, defaults to a folder named after the job in the output folder.
+"""
+
+import os
+import glob
+import json
+import time
+import yaml
+
+from colorama import AnsiToWin32
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from program_files.configuration_manager import Configuration
+from program_files.settings import BATCH_LOG, BATCH_REPORT, CONFIG_PATH, DATA_PATH, OUTPUT_PATH
+from program_files.helpers import ToolError, set_headless, set_cores, info, error, warning
+
+# Number of configuration files needed by each operation.
+OPERATIONS = {'match': 2, 'dedupe': 1, 'links': 1, 'diff': 2, 'changes': 1}
+
+
+def run_batch(manifest_path: str, workers=None, cores=None) -> int:
+    """ Runs every job in a manifest. Returns the exit status of the batch, 0 if every job succeeded, 1 if any
+        job failed and 2 if the manifest could not be read. If cores is given, every job scores with that many cores. """
+
+    # Errors in the manifest are reported without prompting, so that the batch can be run by a scheduler.
+    set_headless()
+
+    try:
+        manifest = read_manifest(manifest_path)
+    except ToolError:
+        return 2
+
+    jobs = manifest['jobs']
+
+    # One worker per job unless specified, but no more workers than there are CPUs.
+    if workers is None:
+        workers = manifest.get('workers') or min(len(jobs), os.cpu_count() or 1)
+
+    # Jobs running at the same time share available cores, unless told how many to use.
+    for job in jobs:
+        job['cores'] = cores or job.get('cores')
+        job['share'] = min(workers, len(jobs))
+
+    info('Running ' + str(len(jobs)) + ' job(s) using ' + str(workers) + ' worker process(es).', pre='\n')
+
+    results = []
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        future_to_job = {executor.submit(run_job, job): job for job in jobs}
+
+        for future in as_completed(future_to_job):
+            job = future_to_job[future]
+
+            try:
+                result = future.result()
+            except Exception as e:
+                # Worker process died (eg. ran out of memory) before it could report a result.
+                result = job_result(job, 'failed', 0.0, 'Worker process failed: ' + str(e))
+
+            results.append(result)
+            report_job(result)
+
+    total = time.perf_counter() - start
+
+    # Write machine readable report of the whole batch.
+    os.makedirs(OUTPUT_PATH, exist_ok=True)
+    with open(OUTPUT_PATH + BATCH_REPORT, 'w') as report:
+        json.dump({'manifest': manifest_path, 'workers': workers, 'seconds': round(total, 3), 'jobs': results}, report, indent=2)
+
+    failed = [result for result in results if result['status'] != 'ok']
+
+    info('Finished ' + str(len(results)) + ' job(s) in ' + '%.1f' % total + 's, ' + str(len(failed)) + ' failed. ' +
+         'Report saved to ' + OUTPUT_PATH + BATCH_REPORT, pre='\n')
+
+    return 1 if failed else 0
+
+
+def read_manifest(manifest_path: str) -> dict:
+    """ Reads and validates a job manifest. Fills in default values of optional job options. """
+
+    try:
+        with open(manifest_path, 'r') as manifest_file:
+            manifest = yaml.safe_load(manifest_file)
+    except OSError:
+        error('Could not find job manifest at ' + manifest_path)
+    except yaml.YAMLError as e:
+        error('Malformed job manifest. Please ensure the file contains only valid YAML.\n\n', post=str(e))
+
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('jobs'), list) or len(manifest['jobs']) < 1:
+        error('Job manifest must contain a list of at least one job under \'jobs\'.')
+
+    if manifest.get('workers') is not None and (not isinstance(manifest['workers'], int) or manifest['workers'] < 1):
+        error('Job manifest has an invalid number of workers \'' + str(manifest['workers']) + '\'. Must be a whole number greater than zero.')
+
+    names = set()
+
+    for number, job in enumerate(manifest['jobs'], 1):
+        if not isinstance(job, dict):
+            error('Job ' + str(number) + ' in the manifest is not a set of options.')
+
+        operation = job.get('operation')
+        if operation not in OPERATIONS:
+            error('Job ' + str(number) + ' has an invalid operation \'' + str(operation) + '\'. Must be one of ' + str(list(OPERATIONS)))
+
+        # Ensure that configs and inputs are lists if a single value is given
+        for option in ['configs', 'inputs']:
+            if job.get(option) is not None and not isinstance(job[option], list):
+                job[option] = [job[option]]
+
+        if job.get('configs') is None or len(job['configs']) != OPERATIONS[operation]:
+            error('Job ' + str(number) + ' (' + operation + ') needs ' + str(OPERATIONS[operation]) + ' configuration file(s).')
+
+        if job.get('inputs') is not None and len(job['inputs']) != len(job['configs']):
+            error('Job ' + str(number) + ' must give one input file per configuration file.')
+
+        if job.get('cores') is not None and (not isinstance(job['cores'], int) or job['cores'] < 1):
+            error('Job ' + str(number) + ' has an invalid number of cores \'' + str(job['cores']) + '\'. Must be a whole number greater than zero.')
+
+        # Job names must be unique as they name output folders
+        job['name'] = str(job.get('name') or str(number) + '-' + operation)
+        if job['name'] in names:
+            error('More than one job is called \'' + job['name'] + '\'. Job names must be unique.')
+        names.add(job['name'])
+
+        job['configs'] = [config if os.path.dirname(config) else CONFIG_PATH + config for config in job['configs']]
+        job['inputs'] = job.get('inputs') or [None] * len(job['configs'])
+        job['output'] = os.path.join(job.get('output') or OUTPUT_PATH + job['name'], '')
+
+    return manifest
+
+
+def run_job(job: dict) -> dict:
+    """ Runs a single job in a worker process. Everything the job prints is written to a log in its output folder. """
+
+    # Nobody can answer prompts in a worker, errors are raised instead.
+    set_headless()
+    set_cores(job['cores'], share=job['share'])
+
+    os.makedirs(job['output'], exist_ok=True)
+    start = time.perf_counter()
+
+    # Colour codes are stripped from the log.
+    with open(job['output'] + BATCH_LOG, 'w') as log, redirect_stdout(AnsiToWin32(log, strip=True).stream):
+        try:
+            run_operation(job)
+            (status, message) = ('ok', '')
+        except ToolError as e:
+            (status, message) = ('failed', str(e))
+        except (Exception, SystemExit) as e:
+            (status, message) = ('failed', type(e).__name__ + ': ' + str(e))
+
+    return job_result(job, status, time.perf_counter() - start, message)
+
+
+def run_operation(job: dict) -> None:
+    """ Loads configurations and input files of a job and runs its operation. """
+
+    confs = [Configuration(config) for config in job['configs']]
+
+    for conf, input_path in zip(confs, job['inputs']):
+        conf.path = input_path if input_path is not None else find_input(conf)
+
+    # Options are imported here so that each worker process only loads what its job needs.
+    if job['operation'] == 'match':
+        from program_files.record_matcher import link_records
+        link_records(confs[0], confs[1], format=job.get('mode') == 'ucas', output_path=job['output'], settings_file=job.get('model'),
+                     incremental=bool(job.get('incremental')))
+    elif job['operation'] == 'dedupe':
+        from program_files.duplicate_detector import find_duplicates
+        find_duplicates(confs[0], output_path=job['output'], settings_file=job.get('model'))
+    elif job['operation'] == 'links':
+        from program_files.link_checker import verify_links
+        verify_links(confs[0], output_path=job['output'])
+    elif job['operation'] == 'diff':
+        from program_files.difference_detector import find_differences
+        find_differences(confs[0], confs[1], output_path=job['output'])
+    elif job['operation'] == 'changes':
+        from program_files.difference_detector import find_changes
+        find_changes(confs[0], output_path=job['output'])
+
+
+def find_input(conf) -> str:
+    """ Returns path of the only file in a configuration's data folder. Unlike get_file_path, never prompts. """
+
+    folder_contents = glob.glob(os.path.join(DATA_PATH + conf.folder_name, '*.*'))
+
+    if len(folder_contents) != 1:
+        error('The ' + conf.folder_name + ' data folder must contain a single data file, or an input must be given in the manifest.')
+
+    return folder_contents[0]
+
+
+def job_result(job: dict, status: str, seconds: float, message: str) -> dict:
+    """ Returns result of a job, as reported. """
+
+    return {'name': job['name'],
+            'operation': job['operation'],
+            'status': status,
+            'seconds': round(seconds, 3),
+            'message': message,
+            'output': job['output']}
+
+
+def report_job(result: dict) -> None:
+    """ Prints result of a finished job. """
+
+    summary = result['name'] + ' (' + result['operation'] + ') ' + result['status'] + ' after ' + '%.1f' % result['seconds'] + 's'
+
+    if result['status'] == 'ok':
+        info(summary)
+    else:
+        warning(summary + ': ' + result['message'].rstrip('.') + '. See ' + result['output'] + BATCH_LOG)
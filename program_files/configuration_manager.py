@@ -29,6 +29,7 @@ class Configuration():
         self.characters_to_clean = self.__load('characters_to_clean', can_be_blank=True)
         self.column_names = self.__load('column_names')
         self.recall_weight = self.__load('recall_weight')
+        self.num_cores = self.__load('num_cores', can_be_blank=True)
         self.url_columns = self.__load('url_columns', can_be_blank=True)
         self.id_column = self.__load('id_column', can_be_blank=True)
         self.diff_columns = self.__load('diff_columns', can_be_blank=True)
@@ -101,10 +102,19 @@ class Configuration():
         if self.recall_weight < 1:
             error('Recall weight must be greater than zero.')
 
+        # Number of cores must be a whole number greater than zero
+        if self.num_cores is not None and (not isinstance(self.num_cores, int) or self.num_cores < 1):
+            error('Number of cores must be a whole number greater than zero. \'' + str(self.num_cores) + '\' is invalid.')
+
         # Ensure that url columns is list if single column given by user
         if not isinstance(self.url_columns, list):
             self.url_columns = [self.url_columns]
         
         # Ensure that diff columns is list if single column given by user
         if not isinstance(self.diff_columns, list):
-            self.diff_columns = [self.diff_columns]
\ No newline at end of file
+            self.diff_columns = [self.diff_columns]
+
+        # Each diff column can only be compared once
+        for column in self.diff_columns:
+            if self.diff_columns.count(column) > 1:
+                error('Diff columns can only be listed once. \'' + str(column) + '\' is repeated.')
\ No newline at end of file
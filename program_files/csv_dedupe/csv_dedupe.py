@@ -11,22 +11,22 @@ import logging
 
 from io import open
 from . import csv_helpers
+from .model_store import ModelStore
 from dedupe.core import BlockingError
 from program_files.helpers import error
-from program_files.settings import DATA_PATH, TEMP_PATH
+from program_files.settings import OUTPUT_PATH
 
 class CsvDedupe(csv_helpers.CsvSetup):
-    def __init__(self, conf):
-        super(CsvDedupe, self).__init__(conf)
+    def __init__(self, conf, data, rows, output_path=OUTPUT_PATH, settings_file=None):
+        super(CsvDedupe, self).__init__(conf, output_path)
 
-        """ Following initialisation, sets up input file and fields for deduper. """
+        """ Following initialisation, sets up input data and fields for deduper. """
 
-        input = DATA_PATH + TEMP_PATH  + 'option_two_temp.csv'
+        # Data frame (of the fields being compared) to be deduplicated
+        self.input = data
 
-        try:
-            self.input = open(input, encoding='utf-8').read()
-        except IOError:
-            error('Could not find input file at ' + input)
+        # Rows of the file, in the same order as the data frame. Used to write original records to the results.
+        self.rows = rows
 
         # Set field names from configuration file 
         self.field_names = conf.column_names
@@ -34,20 +34,20 @@ class CsvDedupe(csv_helpers.CsvSetup):
         # Dedupe settings. Not modifiable via config
         self.field_definition = [{'field': field, 'type': 'String'} for field in self.field_names]
 
+        # Find model trained by an earlier run on the same configuration and fields
+        self.load_model(ModelStore('dedupe', [conf], self.field_definition), settings_file)
+
 
     def run(self):
         """ Runs the deduper program. """
 
-        # import the specified CSV file
-        data_d = csv_helpers.readData(self.input, delimiter=self.delimiter)
+        # sanity check for provided field names in data
+        csv_helpers.check_fields(self.input, self.field_names)
 
-        logging.info('imported %d rows', len(data_d))
+        # Create records from the imported data
+        data_d = csv_helpers.readData(self.input, self.field_names)
 
-        # sanity check for provided field names in CSV file
-        for field in self.field_definition:
-            if field['type'] != 'Interaction':
-                if not field['field'] in data_d[0]:
-                    error("Could not find column '" + str(field.get('field')) + "' please check it is present in data set, spelt correctly and has same case.")
+        logging.info('imported %d rows', len(data_d))
 
         logging.info('using fields: %s' % [field['field'] for field in self.field_definition])
 
@@ -56,14 +56,14 @@ class CsvDedupe(csv_helpers.CsvSetup):
             # Load our deduper from the last training session cache.
             logging.info('reading from previous training cache %s' % self.settings_file)
             with open(self.settings_file, 'rb') as f:
-                deduper = dedupe.StaticDedupe(f)
+                deduper = dedupe.StaticDedupe(f, num_cores=self.num_cores)
 
             fields = {variable.field for variable in deduper.data_model.primary_fields}
             unique_d, parents = exact_matches(data_d, fields)
 
         else:
             # Create a new deduper object and pass our data model to it.
-            deduper = dedupe.Dedupe(self.field_definition)
+            deduper = dedupe.Dedupe(self.field_definition, num_cores=self.num_cores)
 
             fields = {variable.field for variable in deduper.data_model.primary_fields}
             unique_d, parents = exact_matches(data_d, fields)
@@ -84,13 +84,14 @@ class CsvDedupe(csv_helpers.CsvSetup):
         # When we set the recall weight to 2, we are saying we care twice as much
         # about recall as we do precision.
         #
-        # If we had more data, we would not pass in all the blocked data into
-        # this function but a representative sample.
+        # With a lot of data, only pairs blocked from a representative sample of
+        # records are scored (see THRESHOLD_SAMPLE in settings).
 
         logging.info('finding a good threshold with a recall_weight of %s' % self.recall_weight)
         
         try:
-            threshold = deduper.threshold(unique_d, recall_weight=self.recall_weight)
+            with csv_helpers.measure('Finding threshold', self.num_cores):
+                threshold = self.find_threshold(deduper, unique_d)
         except BlockingError as e:
             error('No records could be linked together. This is likely caused by only saying no during training.')
 
@@ -98,9 +99,11 @@ class CsvDedupe(csv_helpers.CsvSetup):
         # believes are all referring to the same entity.
 
         logging.info('clustering...')
-        clustered_dupes = deduper.match(unique_d, threshold)
+        with csv_helpers.measure('Clustering', self.num_cores):
+            clustered_dupes = deduper.match(unique_d, threshold)
 
         expanded_clustered_dupes = []
+        clustered = set()
         for cluster, scores in clustered_dupes:
             new_cluster = list(cluster)
             new_scores = list(scores)
@@ -108,8 +111,14 @@ class CsvDedupe(csv_helpers.CsvSetup):
                 children = parents.get(row_id, [])
                 new_cluster.extend(children)
                 new_scores.extend([score] * len(children))
+                clustered.add(row_id)
             expanded_clustered_dupes.append((new_cluster, new_scores))
 
+        # Exact duplicates are duplicates even if nothing else was found like them.
+        for row_id, children in parents.items():
+            if row_id not in clustered:
+                expanded_clustered_dupes.append(([row_id] + children, [1.0] * (len(children) + 1)))
+
         clustered_dupes = expanded_clustered_dupes
 
         logging.info('# duplicate sets %s' % len(clustered_dupes))
@@ -118,20 +127,14 @@ class CsvDedupe(csv_helpers.CsvSetup):
 
         if self.results_file:
             with open(self.results_file, 'w', newline='') as results_file:
-                write_function(clustered_dupes, self.input, results_file)
+                write_function(clustered_dupes, self.rows, results_file)
         else:
-            write_function(clustered_dupes, self.input, sys.stdout)
+            write_function(clustered_dupes, self.rows, sys.stdout)
 
 
 def exact_matches(data_d, match_fields):
-    unique = {}
-    redundant = {}
-    for key, record in data_d.items():
-        record_hash = hash(tuple(record[f] for f in match_fields))
-        if record_hash not in redundant:
-            unique[key] = record
-            redundant[record_hash] = (key, [])
-        else:
-            redundant[record_hash][1].append(key)
+    """ Groups records that are equal in every match field. Returns one record from each group, to be clustered, 
+        and the IDs of the others in each group, by the ID of the record kept. """
 
-    return unique, {k: v for k, v in redundant.values()}
+    (groups,) = csv_helpers.exact_groups([data_d], sorted(match_fields))
+    return csv_helpers.group_records(data_d, groups)
@@ -5,96 +5,169 @@ Functions used by csv_dedupe and csv_link for setup, pre-processing, data readin
 """
 
 import os
-import re
 import csv
+import time
+import numpy
+import random
 import dedupe
 import logging
 import platform
-
-from io import StringIO, open
-from program_files.helpers import info
-from program_files.settings import A_ONLY, B_ONLY, DATA_PATH, POTENTIAL_DUPLICATES, POTENTIAL_MATCHES, TRAINING_PATH, OUTPUT_PATH
+import itertools
+import pandas as pd
+
+from io import open
+from dedupe import core
+from contextlib import contextmanager
+from pandas import DataFrame, Series
+from program_files.menu import SingleSelectionMenu
+from program_files.helpers import info, error, todo, is_headless, get_cores
+from program_files.settings import A_ONLY, B_ONLY, NUM_CORES, POTENTIAL_DUPLICATES, POTENTIAL_MATCHES, OUTPUT_PATH, \
+                                   THRESHOLD_REPORT, THRESHOLD_SAMPLE, WRITE_CHUNK_SIZE
 
 if platform.system() != 'Windows':
     from signal import signal, SIGPIPE, SIG_DFL
     signal(SIGPIPE, SIG_DFL)
 
 
-def pre_process(column):
+def pre_process(column: Series) -> list:
     """
-    Do a little bit of data cleaning. Things like casing, extra spaces, 
-    quotes and new lines are ignored.
+    Do a little bit of data cleaning on a whole column at once. Things like 
+    casing, extra spaces, quotes and new lines are ignored. Registry data 
+    repeats the same values often, so each unique value is only cleaned 
+    once and the result is copied to every row it appears in.
     """
-    column = re.sub('  +', ' ', column)
-    column = re.sub('\n', ' ', column)
-    column = column.strip().strip('"').strip("'").lower().strip()
+    codes, uniques = pd.factorize(column)
+
+    cleaned = pd.Series(uniques, dtype=object).astype(str)
+    cleaned = cleaned.str.replace('  +', ' ', regex=True).str.replace('\n', ' ', regex=False)
+    cleaned = cleaned.str.strip().str.strip('"').str.strip("'").str.lower().str.strip()
+
+    cleaned = cleaned.to_numpy(dtype=object)
+    cleaned[cleaned == ''] = None
 
-    if column == '':
-        column = None
-    return column
+    return cleaned[codes].tolist()
 
 
-def readData(input_file, delimiter=',', prefix=None) -> dict:
+def readData(data: DataFrame, fields: list, names=None) -> dict:
     """
-    Read in our data from a CSV file and create a dictionary of records, 
+    Read in our data from a data frame and create a dictionary of records, 
     where the key is a unique record ID and each value is a dict 
-    of the row fields.
+    of the given fields. The record ID is the position of the row in the 
+    data frame, so results can be joined back to the rows by position. 
+    Fields can be given different names in the records, eg. to match 
+    another data set.
 
     **Currently, dedupe depends upon records' unique ids being integers
     with no integers skipped. The smallest valued unique id must be 0 or
     1. Expect this requirement will likely be relaxed in the future.**
     """
 
-    data = {}
+    if names is None:
+        names = fields
 
-    reader = csv.DictReader(StringIO(input_file), delimiter=delimiter)
-    for i, row in enumerate(reader):
-        clean_row = {k: pre_process(v) for (k, v) in row.items() if k is not None}
-        if prefix:
-            row_id = u"%s|%s" % (prefix, i)
-        else:
-            row_id = i
-        data[row_id] = clean_row
+    # Clean only the fields being compared, one column at a time.
+    columns = [pre_process(data[field]) for field in fields]
+
+    return {row_id: dict(zip(names, row)) for row_id, row in enumerate(zip(*columns))}
+
+
+def exact_groups(record_sets: list, fields: list) -> list:
+    """
+    Numbers records so that records with equal values in every given field
+    share a number, across all of the given sets of records. Each field is
+    factorized on its own and the codes are combined into a composite key
+    one field at a time, so values are compared exactly and records that
+    differ never share a number (unlike hashes, which can collide). Records
+    with no values at all are each given a number of their own. Returns an
+    array of numbers for each set of records.
+    """
+
+    sizes = [len(records) for records in record_sets]
+
+    groups = numpy.zeros(sum(sizes), dtype=numpy.int64)
+    empty = numpy.ones(sum(sizes), dtype=bool)
+
+    for field in fields:
+        values = numpy.array([record[field] for records in record_sets for record in records.values()], dtype=object)
+        (codes, uniques) = pd.factorize(values)
+
+        # Missing values are coded -1, so codes are shifted to start from 0. The composite key stays below
+        # (number of records)², and is numbered again so that it never grows past the number of records.
+        groups = pd.factorize(groups * (len(uniques) + 1) + (codes + 1))[0]
+        empty &= codes == -1
+
+    groups[empty] = groups.max(initial=-1) + 1 + numpy.arange(numpy.count_nonzero(empty))
+
+    return numpy.split(groups, numpy.cumsum(sizes)[:-1])
+
+
+def group_records(records: dict, groups, exclude=()) -> tuple:
+    """
+    Keeps the first record of each group of records (see exact_groups),
+    leaving out records in excluded groups. Returns the records kept and,
+    for each record kept that has exact duplicates, the IDs of the others.
+    """
+
+    ids = numpy.fromiter(records.keys(), dtype=numpy.int64, count=len(records))
+
+    keep = ~numpy.isin(groups, exclude)
+    (ids, groups) = (ids[keep], groups[keep])
+
+    first = numpy.sort(numpy.unique(groups, return_index=True)[1])
+    kept = {record_id: records[record_id] for record_id in ids[first].tolist()}
 
-    return data
+    # Members of each group with more than one record, in the order they appear. The first is the record kept.
+    repeated = pd.Series(groups).duplicated(keep=False).to_numpy()
+    order = numpy.argsort(groups[repeated], kind='stable')
+    (ids, groups) = (ids[repeated][order], groups[repeated][order])
 
+    members = numpy.split(ids, numpy.flatnonzero(groups[1:] != groups[:-1]) + 1) if len(ids) else []
 
-def write_results(clustered_dupes, input_file, results_file):
-    """ Writes original data back out to a CSV with a new column called 'Cluster ID' indicating which records refer to each other. """
+    return kept, {group[0]: group[1:] for group in map(numpy.ndarray.tolist, members)}
+
+
+def check_fields(data: DataFrame, fields: list) -> None:
+    """ Sanity check for provided field names in data. """
+
+    for field in fields:
+        if field not in data.columns:
+            error("Could not find column '" + str(field) + "' please check it is present in data set, spelt correctly and has same case.")
+
+
+def write_results(clustered_dupes, rows, results_file):
+    """ Writes original data back out to a CSV with a new column called 'Cluster ID' indicating which records refer to each other. 
+        Rows are written a chunk at a time, fetched by position from the rows of the file. """
 
     info('Saving results to ' + results_file.name)
 
-    cluster_membership = {}
+    # Cluster of every row, by position. Record IDs are row positions.
+    membership = numpy.full(len(rows), -1, dtype=numpy.int64)
+
     for cluster_id, (cluster, score) in enumerate(clustered_dupes):
-        for record_id in cluster:
-            cluster_membership[record_id] = cluster_id
+        membership[numpy.asarray(cluster, dtype=numpy.int64)] = cluster_id
 
-    unique_record_id = cluster_id + 1
+    # Rows that aren't in a cluster are each given a cluster of their own, numbered after the others.
+    unclustered = membership < 0
+    membership[unclustered] = numpy.arange(len(clustered_dupes), len(clustered_dupes) + unclustered.sum())
 
     writer = csv.writer(results_file)
 
-    reader = csv.reader(StringIO(input_file))
-
-    heading_row = next(reader)
+    heading_row = list(rows.header)
     heading_row.insert(0, u'Cluster ID')
     writer.writerow(heading_row)
 
-    for row_id, row in enumerate(reader):
-        if row_id in cluster_membership:
-            cluster_id = cluster_membership[row_id]
-        else:
-            cluster_id = unique_record_id
-            unique_record_id += 1
-        row.insert(0, cluster_id)
-        writer.writerow(row)
+    for start in range(0, len(rows), WRITE_CHUNK_SIZE):
+        chunk = numpy.arange(start, min(start + WRITE_CHUNK_SIZE, len(rows)))
+        writer.writerows((cluster_id,) + row for cluster_id, row in zip(membership[chunk].tolist(), rows.fetch(chunk)))
 
 
-def write_linked_results(clustered_pairs, input_1, input_2, potential_matches, a_only, b_only,
+def write_linked_results(clustered_pairs, rows_1, rows_2, potential_matches, a_only, b_only,
                          inner_join=False) -> None:
-    """ Writes results when two csv files are being searched for duplicates. 
+    """ Writes results when two data frames are being searched for duplicates. 
         - Potential matches: written to a file with combined headers. 
         - Records unique to first file written to file a_only.csv.
         - Records unique to second file written to file b_only.csv.\n 
+        Rows are written a chunk at a time, fetched by position from the rows of each file.\n
         NB: Only used in csv_linker.
     """
 
@@ -102,25 +175,20 @@ def write_linked_results(clustered_pairs, input_1, input_2, potential_matches, a
     info('Saving records that only appeared in data_a data to: ' + a_only.name)
     info('Saving records that only appeared in data_b data to: ' + b_only.name)
 
-    matched_records = []
-    seen_1 = set()
-    seen_2 = set()
+    # Positions of the rows in each pair. Record IDs are row positions.
+    pairs = numpy.array([pair for (pair, score) in clustered_pairs], dtype=numpy.int64).reshape(-1, 2)
 
-    input_1 = [row for row in csv.reader(StringIO(input_1))]
-    row_header = input_1.pop(0)
+    # Marks rows of each file that are in a pair
+    seen_1 = numpy.zeros(len(rows_1), dtype=bool)
+    seen_2 = numpy.zeros(len(rows_2), dtype=bool)
+    seen_1[pairs[:, 0]] = True
+    seen_2[pairs[:, 1]] = True
 
-    input_2 = [row for row in csv.reader(StringIO(input_2))]
-    row_header_2 = input_2.pop(0)
+    row_header = list(rows_1.header)
+    row_header_2 = list(rows_2.header)
 
     all_headers = ['Match'] + row_header + row_header_2
 
-    for pair in clustered_pairs:
-        index_1, index_2 = [int(index.split('|', 1)[1]) for index in pair[0]]
-
-        matched_records.append(input_1[index_1] + input_2[index_2])
-        seen_1.add(index_1)
-        seen_2.add(index_2)
-
     # Create csv writers for all output files using passed in filenames
     match_writer = csv.writer(potential_matches)
     a_only_writer = csv.writer(a_only)
@@ -131,57 +199,207 @@ def write_linked_results(clustered_pairs, input_1, input_2, potential_matches, a
     a_only_writer.writerow(row_header)
     b_only_writer.writerow(row_header_2)
 
-    # Write all matches to file 
-    for matches in matched_records:
-        match_writer.writerow([''] + matches)
+    # Write all matches to file, fetching the rows of a chunk of pairs at a time
+    for start in range(0, len(pairs), WRITE_CHUNK_SIZE):
+        chunk = pairs[start:start + WRITE_CHUNK_SIZE]
+        matched = zip(rows_1.fetch(chunk[:, 0]), rows_2.fetch(chunk[:, 1]))
+        match_writer.writerows(('',) + row_1 + row_2 for row_1, row_2 in matched)
 
     if not inner_join:
 
         # Print rows that were only in input one 
-        for i, row in enumerate(input_1):
-            if i not in seen_1:
-                a_only_writer.writerow(row)
+        write_unseen(a_only_writer, rows_1, seen_1)
 
         # Print rows that were only in input two
-        for i, row in enumerate(input_2):
-            if i not in seen_2:
-                b_only_writer.writerow(row)
+        write_unseen(b_only_writer, rows_2, seen_2)
+
+
+def write_unseen(writer, rows, seen) -> None:
+    """ Writes rows that haven't been seen, a chunk at a time. """
+
+    for start in range(0, len(rows), WRITE_CHUNK_SIZE):
+        writer.writerows(rows.fetch(numpy.flatnonzero(~seen[start:start + WRITE_CHUNK_SIZE]) + start))
+
+
+def choose_cores(conf) -> int:
+    """ Returns number of cores to score record pairs with. The command line takes priority, then the configuration 
+        file, then settings. Otherwise available cores are shared equally between jobs running at the same time. """
+
+    (cores, share) = get_cores()
+
+    for number in [cores, conf.num_cores, NUM_CORES]:
+        if number is not None:
+            return number
+
+    return max(available_cores() // share, 1)
+
+
+def available_cores() -> int:
+    """ Returns number of cores this process may run on. Unlike cpu_count, respects limits set by the system (eg. taskset). """
+
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def cpu_time() -> float:
+    """ Returns CPU time used by this process and its finished child processes (eg. dedupe's scoring processes). """
+
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+@contextmanager
+def measure(stage: str, num_cores: int):
+    """ Reports time taken by a stage and the CPU time used. CPU time divided by time taken is the speedup from using more cores. """
+
+    (start, start_cpu) = (time.perf_counter(), cpu_time())
+    yield
+    (elapsed, used) = (time.perf_counter() - start, cpu_time() - start_cpu)
+
+    speedup = used / elapsed if elapsed > 0 else 1.0
+    info('%s took %.1fs using %d core(s), %.1fs of CPU time (%.1fx speedup).' % (stage, elapsed, num_cores, used, speedup))
+
+
+def sample_records(records: dict, size) -> dict:
+    """ Returns a random sample of records. Size is a number of records, or a fraction of them if below 1. 
+        The same records are sampled every run. """
+
+    if size is None:
+        return records
+
+    count = int(len(records) * size) if size < 1 else int(size)
+
+    if count >= len(records):
+        return records
+
+    return {key: records[key] for key in random.Random(0).sample(list(records), count)}
+
+
+def precision_recall(probability) -> tuple:
+    """ Returns scores of pairs (highest first) with the expected precision and recall if each score were the threshold. """
+
+    probability = numpy.sort(probability)[::-1]
+
+    # A pair with a score of 0.8 is expected to be a match 80% of the time
+    expected_dupes = numpy.cumsum(probability)
+
+    recall = expected_dupes / expected_dupes[-1]
+    precision = expected_dupes / numpy.arange(1, len(expected_dupes) + 1)
+
+    return (probability, precision, recall)
+
+
+def write_threshold_report(report_path: str, probability, precision, recall, chosen: float) -> None:
+    """ Writes number of sampled pairs, expected precision and recall at thresholds from 0.05 to 0.95 and at the chosen threshold. """
+
+    thresholds = sorted(set(numpy.round(numpy.arange(0.05, 1, 0.05), 2)) | {round(float(chosen), 3)})
+
+    with open(report_path, 'w', newline='') as report:
+        writer = csv.writer(report)
+        writer.writerow(['Threshold', 'Chosen', 'Sampled pairs at or above threshold', 'Precision', 'Recall'])
+
+        for threshold in thresholds:
+            # Number of scores at or above the threshold. Scores are highest first, so negate to search.
+            count = numpy.searchsorted(-probability, -threshold, side='right')
+
+            if count == 0:
+                writer.writerow([threshold, threshold == round(float(chosen), 3), 0, '', 0.0])
+            else:
+                writer.writerow([threshold, threshold == round(float(chosen), 3), count,
+                                 '%.4f' % precision[count - 1], '%.4f' % recall[count - 1]])
 
 
 class CsvSetup(object):
-    def __init__(self, conf_a) -> None:
+    def __init__(self, conf_a, output_path=OUTPUT_PATH) -> None:
         """ Initialises configuration information for the CsvSetup class. """
 
         # File names for record matcher 
-        self.potential_matches = OUTPUT_PATH + POTENTIAL_MATCHES
-        self.a_only = OUTPUT_PATH + A_ONLY
-        self.b_only = OUTPUT_PATH + B_ONLY
+        self.potential_matches = output_path + POTENTIAL_MATCHES
+        self.a_only = output_path + A_ONLY
+        self.b_only = output_path + B_ONLY
 
         # File name for duplicate detector
-        self.results_file = OUTPUT_PATH + POTENTIAL_DUPLICATES
+        self.results_file = output_path + POTENTIAL_DUPLICATES
 
-        # Training files
-        self.training_file = DATA_PATH + TRAINING_PATH + 'training.json'
-        self.settings_file = DATA_PATH + TRAINING_PATH + 'cached_settings'
+        # Estimated precision and recall of possible thresholds
+        self.threshold_report = output_path + THRESHOLD_REPORT
 
         # Set recall weight from config 
         self.recall_weight = conf_a.recall_weight
 
         # Dedupe Settings. These are only configurable here.
         self.sample_size = 1500
-        self.delimiter = ','
-        self.skip_training = False  # Always false to make program simpler, users must always train AI
+        self.threshold_sample = THRESHOLD_SAMPLE
+
+        # Number of cores used to score record pairs
+        self.num_cores = choose_cores(conf_a)
+
+        # Trained model. Set up by load_model once the field definition is known.
+        self.model = None
+        self.training_file = None
+        self.settings_file = None
+        self.skip_training = False  # True when a saved model is used instead of training.
+
+    def load_model(self, model, settings_file=None) -> None:
+        """ Finds saved model and labelled examples in the model store. If a compatible model was saved by an 
+            earlier run, the user can choose to use it rather than training again. A settings file can be 
+            given to use a particular trained model instead. """
+
+        self.model = model
+        self.training_file = model.training_file()
+        self.settings_file = model.settings_file()
+
+        if settings_file is not None:
+            # Use the given model
+            self.settings_file = settings_file
+            self.skip_training = True
+
+        elif self.settings_file is not None and is_headless():
+            # Nobody is available to choose, so use the saved model
+            self.skip_training = True
+
+        elif self.settings_file is not None:
+            todo('A trained model was found for the selected configuration. Please select an option from the list below.', pre='\n', post='\n')
+
+            model_menu = SingleSelectionMenu(options=['Use saved model (no training required)',
+                                                      'Train again (previously labelled examples are kept)'])
 
-        # Delete existing training data should any be present
-        if os.path.exists(self.training_file):
-            os.remove(self.training_file)
-        if os.path.exists(self.settings_file):
-            os.remove(self.settings_file)
+            self.skip_training = model_menu.show() == 1
+
+        # Training needs a user to label examples
+        if is_headless() and not self.skip_training:
+            error('No trained model was found for ' + model.key + '. Train one using the menu first, or give the path of one.')
+
+    def find_threshold(self, deduper, records: dict, target=None) -> float:
+        """ Returns the threshold that maximizes the expected F score, a weighted average of precision and recall. Works 
+            as dedupe's threshold() does, but only pairs blocked from a sample of records are scored. Target records 
+            (for linking) are not sampled. The estimated precision and recall at a range of thresholds is saved. """
+
+        sample = sample_records(records, self.threshold_sample)
+        logging.info('finding threshold from a sample of %d of %d records' % (len(sample), len(records)))
+
+        # Score every pair blocked from the sample. Raises BlockingError if there are none.
+        blocks = deduper._blockData(sample) if target is None else deduper._blockData(sample, target)
+        candidate_records = itertools.chain.from_iterable(deduper._blockedPairs(blocks))
+        probability = core.scoreDuplicates(candidate_records, deduper.data_model, deduper.classifier, deduper.num_cores)['score']
+
+        (probability, precision, recall) = precision_recall(probability)
+
+        score = recall * precision / (recall + self.recall_weight ** 2 * precision)
+        i = numpy.argmax(score)
+
+        info('Threshold: %.3f (estimated precision %.3f, recall %.3f). Precision and recall of other thresholds saved to %s' %
+             (probability[i], precision[i], recall[i], self.threshold_report))
+
+        write_threshold_report(self.threshold_report, probability, precision, recall, probability[i])
+
+        return float(probability[i])
 
     def dedupe_training(self, deduper) -> None:
-        """ Loads existing training data, or starts manual training process. """
+        """ Loads existing training data, or starts manual training process. The result is saved as a new model version. """
 
-        if os.path.exists(self.training_file):
+        if self.training_file is not None:
             logging.info('Reading labeled examples from %s' % self.training_file)
             with open(self.training_file) as tf:
                 deduper.readTraining(tf)
@@ -190,23 +408,12 @@ class CsvSetup(object):
             logging.info('Starting active labeling...')
 
             dedupe.consoleLabel(deduper)
-
-            # When finished, save our training away to disk
-            logging.info('Saving training data to %s' % self.training_file)
-            
-            # Create directory for training information 
-            if not os.path.exists(DATA_PATH + TRAINING_PATH):
-                os.mkdir(DATA_PATH + TRAINING_PATH)
-            
-            # Write training data to training folder
-            with open(self.training_file, 'w') as tf:
-                deduper.writeTraining(tf)
         else:
             logging.info('Skipping the training step')
 
         deduper.train()
 
-        # After training settings have been established make a cache file for reuse
-        logging.info('Caching training result set to file %s' % self.settings_file)
-        with open(self.settings_file, 'wb') as sf:
-            deduper.writeSettings(sf)
+        # After training, save labelled examples and settings to the model store for reuse
+        version = self.model.save(deduper)
+        self.settings_file = self.model.settings_file()
+        logging.info('Saved trained model %s version %d' % (self.model.key, version))
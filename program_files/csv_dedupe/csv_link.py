@@ -5,34 +5,33 @@ Used by record_matched to identify duplicates accross two csv files.
 """
 
 import os
+import numpy
 import dedupe
 import logging
 
 from io import open
+from pandas import DataFrame
 from . import csv_helpers
+from . import link_index
+from .link_index import BlockingIndex, LinkIndex
+from .model_store import ModelStore
 from dedupe.core import BlockingError
-from program_files.helpers import error
-from program_files.settings import DATA_PATH, TEMP_PATH
+from program_files.helpers import info, error
+from program_files.settings import OUTPUT_PATH
 
 class CsvLink(csv_helpers.CsvSetup):
-    def __init__(self, conf_a, conf_b):
-        super(CsvLink, self).__init__(conf_a)
+    def __init__(self, conf_a, data_a, rows_a, conf_b, data_b, rows_b, output_path=OUTPUT_PATH, settings_file=None, incremental=False):
+        super(CsvLink, self).__init__(conf_a, output_path)
 
-        """ Following initialisation, sets up input files and fields for linker. """
+        """ Following initialisation, sets up input data and fields for linker. """
 
-        input_one = DATA_PATH + TEMP_PATH + 'temp_a.csv'
-        input_two = DATA_PATH + TEMP_PATH + 'temp_b.csv'
-
-        try:
-            self.input_1 = open(input_one, encoding='utf-8').read()
-        except IOError:
-            error('Could not find input file at ' + input_one)
-
-        try:
-            self.input_2 = open(input_two, encoding='utf-8').read()
-        except IOError:
-            error('Could not find input file at ' + input_two)
+        # Data frames (of the fields being compared) to be linked
+        self.input_1 = data_a
+        self.input_2 = data_b
 
+        # Rows of each file, in the same order as the data frames. Used to write original records to the results.
+        self.rows_1 = rows_a
+        self.rows_2 = rows_b
 
         # Set field names from configuration files
         self.field_names_1 = conf_a.column_names
@@ -40,31 +39,25 @@ class CsvLink(csv_helpers.CsvSetup):
         
         # Dedupe settings. Not modifiable via config
         self.inner_join = False
+
+        # True to link only new or modified records in the second file, see link_incrementally
+        self.incremental = incremental
         self.field_definition = [{'field': field, 'type': 'String'} for field in self.field_names_1]
 
+        # Find model trained by an earlier run on the same configurations and fields
+        self.load_model(ModelStore('link', [conf_a, conf_b], self.field_definition, [self.field_names_1, self.field_names_2]), settings_file)
+
 
     def run(self) -> None:
         """ Runs the linking program. """
 
-        # Read configured csv files
-        data_1 = csv_helpers.readData(self.input_1, delimiter=self.delimiter, prefix='input_1')
-        data_2 = csv_helpers.readData(self.input_2, delimiter=self.delimiter, prefix='input_2')
+        # sanity check for provided field names in data
+        csv_helpers.check_fields(self.input_1, self.field_names_1)
+        csv_helpers.check_fields(self.input_2, self.field_names_2)
 
-        # sanity check for provided field names in CSV file
-        for field in self.field_names_1:
-            if field not in list(data_1.values())[0]:
-                error("Could not find column '" + str(field) + "' please check it is present in data set, spelt correctly and has same case.")
-
-        for field in self.field_names_2:
-            if field not in list(data_2.values())[0]:
-                error("Could not find column '" + str(field) + "' please check it is present in data set, spelt correctly and has same case.")
-
-        if self.field_names_1 != self.field_names_2:
-            for record_id, record in data_2.items():
-                remapped_record = {}
-                for new_field, old_field in zip(self.field_names_1, self.field_names_2):
-                    remapped_record[new_field] = record[old_field]
-                    data_2[record_id] = remapped_record
+        # Create records from the imported data. Fields in the second file are renamed to match the first.
+        data_1 = csv_helpers.readData(self.input_1, self.field_names_1)
+        data_2 = csv_helpers.readData(self.input_2, self.field_names_2, names=self.field_names_1)
 
         logging.info('imported %d rows from file 1', len(data_1))
         logging.info('imported %d rows from file 2', len(data_2))
@@ -76,17 +69,18 @@ class CsvLink(csv_helpers.CsvSetup):
             # Load our deduper from the last training session cache.
             logging.info('reading from previous training cache %s' % self.settings_file)
             with open(self.settings_file, 'rb') as f:
-                deduper = dedupe.StaticRecordLink(f)
+                deduper = dedupe.StaticRecordLink(f, num_cores=self.num_cores)
 
-            fields = {variable.field for variable in deduper.data_model.primary_fields}
-            (nonexact_1, nonexact_2, exact_pairs) = exact_matches(data_1, data_2, fields)
+            # Exact matches are found when they are needed, they aren't if linking incrementally.
+            exact = None
 
         else:
             # Create a new deduper object and pass our data model to it.
-            deduper = dedupe.RecordLink(self.field_definition)
+            deduper = dedupe.RecordLink(self.field_definition, num_cores=self.num_cores)
 
             fields = {variable.field for variable in deduper.data_model.primary_fields}
-            (nonexact_1, nonexact_2, exact_pairs) = exact_matches(data_1, data_2, fields)
+            exact = exact_matches(data_1, data_2, fields)
+            (nonexact_1, nonexact_2) = exact[:2]
 
             # Set up our data sample
             logging.info('taking a sample of %d possible pairs', self.sample_size)
@@ -95,22 +89,73 @@ class CsvLink(csv_helpers.CsvSetup):
             # Perform standard training procedures
             self.dedupe_training(deduper)
 
+        if self.incremental:
+            # Only new or modified records are linked, against an index of the first file kept between runs.
+            clustered_dupes = self.link_incrementally(data_1, data_2)
+        else:
+            if exact is None:
+                fields = {variable.field for variable in deduper.data_model.primary_fields}
+                exact = exact_matches(data_1, data_2, fields)
+
+            (nonexact_1, nonexact_2, exact_pairs, children_1, children_2) = exact
+
+            clustered_dupes = self.link(deduper, data_1, nonexact_1, nonexact_2)
+
+            # Links found between records left to be linked hold for every record equal to them.
+            clustered_dupes = [((member_1, member_2), score) for ((id_1, id_2), score) in clustered_dupes
+                               for member_1 in [id_1] + children_1.get(id_1, [])
+                               for member_2 in [id_2] + children_2.get(id_2, [])]
+
+            clustered_dupes.extend(exact_pairs)
+
+            logging.info('# duplicate sets %s' % len(clustered_dupes))
+
+        write_function = csv_helpers.write_linked_results
+
+        # write out our results
+        with open(self.potential_matches, 'w', newline='') as pm, \
+                open(self.a_only, 'w', newline='') as a_only, \
+                open(self.b_only, 'w', newline='') as b_only:
+            write_function(clustered_dupes, self.rows_1, self.rows_2, pm, a_only, b_only, self.inner_join)
+
+
+    def link(self, deduper, data_1, nonexact_1, nonexact_2) -> list:
+        """ Links every record left to be linked in the first file with at most one in the second. Returns linked 
+            pairs. The first file is the reference data. Its blocking index is built from all of its records and
+            kept between runs, so it is only built once for each reference data set and model. """
+
         # ## Blocking
         logging.info('blocking...')
 
+        # dedupe indexes the second data set it is given, so the first file is given second and pairs are swapped back.
+        blocking = BlockingIndex(self.model.key, link_index.file_fingerprint(self.settings_file),
+                                 link_index.fingerprint(self.input_1, self.field_names_1))
+
+        indexed = blocking.linker(self.num_cores)
+
+        if indexed is not None:
+            logging.info('reading blocking index from %s' % blocking.file)
+            deduper = indexed
+        else:
+            # Every record is indexed, not only those left to link, so the index doesn't depend on the other file.
+            deduper.blocker.indexAll(data_1)
+            blocking.save(deduper)
+            deduper.loaded_indices = True
+
         # ## Clustering
 
         # Find the threshold that will maximize a weighted average of our precision and recall. 
         # When we set the recall weight to 2, we are saying we care twice as much
         # about recall as we do precision.
         #
-        # If we had more data, we would not pass in all the blocked data into
-        # this function but a representative sample.
+        # With a lot of data, only pairs blocked from a representative sample of
+        # records are scored (see THRESHOLD_SAMPLE in settings).
 
         logging.info('finding a good threshold with a recall_weight of %s' % self.recall_weight)
         
         try:
-            threshold = deduper.threshold(data_1, data_2, recall_weight=self.recall_weight)
+            with csv_helpers.measure('Finding threshold', self.num_cores):
+                threshold = self.find_threshold(deduper, nonexact_2, target=nonexact_1)
         except BlockingError as e:
             error('No records could be linked together. This is likely caused by only saying no during training.')
 
@@ -118,43 +163,100 @@ class CsvLink(csv_helpers.CsvSetup):
         # believes are all referring to the same entity.
 
         logging.info('clustering...')
-        clustered_dupes = deduper.match(data_1, data_2, threshold)
+        with csv_helpers.measure('Matching', self.num_cores):
+            clustered_dupes = [((id_1, id_2), score) for ((id_2, id_1), score) in deduper.match(nonexact_2, nonexact_1, threshold)]
 
-        clustered_dupes.extend(exact_pairs)
+        return clustered_dupes
 
-        logging.info('# duplicate sets %s' % len(clustered_dupes))
+    def link_incrementally(self, data_1, data_2) -> list:
+        """ Links records in the second file against an index of the first that is kept between runs. Only records 
+            that are new or modified since the last run are blocked and scored, links to the others are reused. 
+            Every record in the second file is linked to its best match, so a record in the first may be linked 
+            more than once. Returns linked pairs. """
 
-        write_function = csv_helpers.write_linked_results
+        index = LinkIndex(self.model.key)
+        reference = link_index.fingerprint(self.input_1, self.field_names_1)
+        hashes = link_index.row_hashes(self.input_2, self.field_names_2)
 
-        # write out our results
-        with open(self.potential_matches, 'w', newline='') as pm, \
-                open(self.a_only, 'w', newline='') as a_only, \
-                open(self.b_only, 'w', newline='') as b_only:
-            write_function(clustered_dupes, self.input_1, self.input_2, pm, a_only, b_only, self.inner_join)
+        if index.load(link_index.file_fingerprint(self.settings_file), reference):
+            logging.info('reading reference index from %s' % index.path)
+            gazetteer = index.gazetteer(self.num_cores)
+            built = None
+
+        else:
+            # Reference data or model has changed (or this is the first run), so index the first file again.
+            info('Indexing ' + str(len(data_1)) + ' reference records. This is only repeated if the reference data or model changes.')
+
+            with open(self.settings_file, 'rb') as f:
+                gazetteer = dedupe.StaticGazetteer(f, num_cores=self.num_cores)
+            gazetteer.index(data_1)
+            built = gazetteer
+
+            # The threshold is found once and reused until the index is rebuilt.
+            logging.info('finding a good threshold with a recall_weight of %s' % self.recall_weight)
+
+            try:
+                with csv_helpers.measure('Finding threshold', self.num_cores):
+                    index.threshold = self.find_threshold(gazetteer, data_2)
+            except BlockingError as e:
+                error('No records could be linked together. This is likely caused by only saying no during training.')
+
+        # One record for each set of values that hasn't been linked before. Records with the same values link the same way.
+        new = {}
+        for record_id, row_hash in zip(data_2, hashes):
+            if row_hash not in index.links:
+                new.setdefault(row_hash, record_id)
+
+        info('Linking ' + str(len(new)) + ' new or modified records. ' + str(len(hashes) - len(new)) + ' records were linked by earlier runs.')
+
+        messy = {record_id: data_2[record_id] for record_id in new.values()}
+        hash_of = {record_id: row_hash for (row_hash, record_id) in new.items()}
+
+        for row_hash in new:
+            index.links[row_hash] = None
+
+        if messy:
+            try:
+                with csv_helpers.measure('Matching', self.num_cores):
+                    for block in gazetteer.match(messy, threshold=index.threshold, n_matches=1, generator=True):
+                        for (messy_id, reference_id), score in zip(block['pairs'], block['score']):
+                            index.links[hash_of[int(messy_id)]] = [int(reference_id), float(score)]
+            except ValueError:
+                # Raised when none of the records share a block with the reference data, so nothing is linked.
+                pass
+
+        # Forget records that are no longer in the second file, then save for the next run.
+        current = set(hashes)
+        index.links = {row_hash: link for (row_hash, link) in index.links.items() if row_hash in current}
+        index.save(built)
+
+        clustered_dupes = []
+        for i, row_hash in enumerate(hashes):
+            link = index.links[row_hash]
+            if link is not None:
+                clustered_dupes.append(((link[0], i), link[1]))
+
+        logging.info('# duplicate sets %s' % len(clustered_dupes))
+
+        return clustered_dupes
 
 
 def exact_matches(data_1, data_2, match_fields):
-    """ Identifies exact and non-exact matches between data sets. """
-
-    nonexact_1 = {}
-    nonexact_2 = {}
-    exact_pairs = []
-    redundant = {}
-
-    for key, record in data_1.items():
-        record_hash = hash(tuple(record[f] for f in match_fields))
-        redundant[record_hash] = key
-
-    for key_2, record in data_2.items():
-        record_hash = hash(tuple(record[f] for f in match_fields))
-        if record_hash in redundant:
-            key_1 = redundant[record_hash]
-            exact_pairs.append(((key_1, key_2), 1.0))
-            del redundant[record_hash]
-        else:
-            nonexact_2[key_2] = record
+    """ Identifies exact and non-exact matches between data sets. Records are grouped if they are equal in every
+        match field, and every record of a group in one data set is an exact match of every record of the same group
+        in the other. Other records are left to be linked, one from each group. Returns records left to be linked,
+        exact pairs, and the IDs of the other records in each group (by the ID of the record left). """
+
+    (groups_1, groups_2) = csv_helpers.exact_groups([data_1, data_2], sorted(match_fields))
+
+    # Every pairing of records in groups found in both data sets.
+    exact = DataFrame({'group': groups_1, 'id_1': numpy.fromiter(data_1, dtype=numpy.int64, count=len(data_1))}) \
+        .merge(DataFrame({'group': groups_2, 'id_2': numpy.fromiter(data_2, dtype=numpy.int64, count=len(data_2))}), on='group')
+
+    exact_pairs = [((id_1, id_2), 1.0) for id_1, id_2 in zip(exact['id_1'].tolist(), exact['id_2'].tolist())]
 
-    for key_1 in redundant.values():
-        nonexact_1[key_1] = data_1[key_1]
+    matched = exact['group'].unique()
+    (nonexact_1, children_1) = csv_helpers.group_records(data_1, groups_1, exclude=matched)
+    (nonexact_2, children_2) = csv_helpers.group_records(data_2, groups_2, exclude=matched)
 
-    return nonexact_1, nonexact_2, exact_pairs
+    return nonexact_1, nonexact_2, exact_pairs, children_1, children_2
@@ -0,0 +1,141 @@
+"""
+Link Index:
+
+Keeps the reference data of an incremental link indexed between runs, along with the link found for every source
+record seen so far. On later runs only new or modified source records are blocked and scored. The index is rebuilt
+if the reference data or the trained model changes.
+
+The blocking index built when linking all records is also kept, so that it is only built once for each reference
+data set and model. It is built from every record of the reference data before the match threshold is found, then
+saved as the linker's settings written with its index (writeSettings(index=True)). dedupe pickles its indices, so a
+saved index is unpickled in full when it is loaded rather than memory-mapped.
+"""
+
+import os
+import glob
+import json
+import dedupe
+import hashlib
+import logging
+
+from pandas import DataFrame
+from pandas.util import hash_pandas_object
+from program_files.helpers import file_lock
+from program_files.settings import BLOCKING_INDEX, DATA_PATH, INDEX_PATH, LINK_STATE, REFERENCE_INDEX
+
+
+class LinkIndex():
+    def __init__(self, key: str) -> None:
+        """ Initialises index kept for the model with the given key. """
+
+        self.path = DATA_PATH + INDEX_PATH + key + '/'
+
+        # State of the index, see load.
+        self.model = None
+        self.reference = None
+        self.threshold = None
+        self.links = {}
+
+    def load(self, model: str, reference: str) -> bool:
+        """ Loads links found by earlier runs. Returns False (and starts empty) if there are none, or if they were
+            found using a different model or reference data. """
+
+        try:
+            with open(self.path + LINK_STATE, 'r') as state_file:
+                state = json.load(state_file)
+        except (OSError, ValueError):
+            state = {}
+
+        if state.get('model') != model or state.get('reference') != reference or not os.path.exists(self.path + REFERENCE_INDEX):
+            (self.model, self.reference, self.threshold, self.links) = (model, reference, None, {})
+            return False
+
+        (self.model, self.reference, self.threshold, self.links) = (model, reference, state['threshold'], state['links'])
+        return True
+
+    def gazetteer(self, num_cores: int):
+        """ Returns gazetteer with the reference data already indexed. """
+
+        with open(self.path + REFERENCE_INDEX, 'rb') as index_file:
+            return dedupe.StaticGazetteer(index_file, num_cores=num_cores)
+
+    def save(self, gazetteer=None) -> None:
+        """ Saves links found so far. The reference index is saved too if a newly built gazetteer is given. """
+
+        os.makedirs(self.path, exist_ok=True)
+
+        # Locked, so that an index and links saved by two processes at the same time aren't mixed up.
+        with file_lock(self.path + LINK_STATE):
+            if gazetteer is not None:
+                with open(self.path + REFERENCE_INDEX + '.tmp', 'wb') as index_file:
+                    gazetteer.writeSettings(index_file, index=True)
+                os.replace(self.path + REFERENCE_INDEX + '.tmp', self.path + REFERENCE_INDEX)
+
+            # Links are saved last, so that they are never paired with an index they weren't found with.
+            state = {'model': self.model, 'reference': self.reference, 'threshold': self.threshold, 'links': self.links}
+
+            with open(self.path + LINK_STATE + '.tmp', 'w') as state_file:
+                json.dump(state, state_file)
+            os.replace(self.path + LINK_STATE + '.tmp', self.path + LINK_STATE)
+
+        logging.info('saved %d links to %s' % (len(self.links), self.path))
+
+
+class BlockingIndex():
+    def __init__(self, key: str, model: str, reference: str) -> None:
+        """ Initialises blocking index kept for the model with the given key, built from the given model and reference data. """
+
+        self.path = DATA_PATH + INDEX_PATH + key + '/'
+
+        # Only one index is kept for each model key. Its name changes if the model or reference data changes.
+        self.file = self.path + BLOCKING_INDEX + '_' + hashlib.sha1((model + reference).encode()).hexdigest()[:16]
+
+    def linker(self, num_cores: int):
+        """ Returns linker with the reference data already indexed (unpickled from the saved settings), or None if it
+            hasn't been indexed yet. """
+
+        if not os.path.exists(self.file):
+            return None
+
+        with open(self.file, 'rb') as index_file:
+            return dedupe.StaticRecordLink(index_file, num_cores=num_cores)
+
+    def save(self, linker) -> None:
+        """ Saves the settings of a linker that has indexed the reference data, with its (pickled) blocking index. 
+            Indices of earlier reference data are removed. """
+
+        os.makedirs(self.path, exist_ok=True)
+
+        # Locked, so that a process removing earlier indices doesn't remove one being written by another.
+        with file_lock(self.path + BLOCKING_INDEX):
+            with open(self.file + '.tmp', 'wb') as index_file:
+                linker.writeSettings(index_file, index=True)
+            os.replace(self.file + '.tmp', self.file)
+
+            for old_file in glob.glob(self.path + BLOCKING_INDEX + '_*'):
+                if old_file != self.file:
+                    os.remove(old_file)
+
+        logging.info('saved blocking index to %s' % self.file)
+
+
+def row_hashes(data: DataFrame, fields: list) -> list:
+    """ Returns a hash of the given fields of every row. Rows with the same values in these fields are linked the same way. """
+    return ['%016x' % value for value in hash_pandas_object(data[fields], index=False).values]
+
+
+def fingerprint(data: DataFrame, fields: list) -> str:
+    """ Returns fingerprint of the given fields of a data frame. Changes if any row is added, removed, modified or moved. """
+    return hashlib.sha1(hash_pandas_object(data[fields], index=False).values.tobytes()).hexdigest()
+
+
+def file_fingerprint(file_path: str) -> str:
+    """ Returns fingerprint of the contents of a file, eg. a trained model. """
+
+    digest = hashlib.sha1()
+
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
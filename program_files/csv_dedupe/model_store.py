@@ -0,0 +1,120 @@
+"""
+Model Store:
+
+Keeps trained models between runs so that they can be reused without training again. A model is identified by the
+configuration(s) and field definition it was trained with. Every training session is saved as a new version holding
+the labelled examples (training.json) and the trained settings (cached_settings).
+"""
+
+import os
+import json
+import hashlib
+import datetime
+
+from importlib import metadata
+from program_files.helpers import file_lock
+from program_files.settings import DATA_PATH, MODELS_PATH
+
+MANIFEST = 'manifest.json'
+TRAINING = 'training.json'
+SETTINGS = 'cached_settings'
+
+
+class ModelStore():
+    def __init__(self, kind: str, confs: list, field_definition: list, field_names=None) -> None:
+        """ Initialises store for the model of the given kind ('link' or 'dedupe') trained on the given configurations.
+            field_names are the names of the fields in each file, if they differ from the field definition. """
+
+        # Models can only be reused with the same fields, so these are part of the key.
+        fields = json.dumps([field_definition, field_names], sort_keys=True)
+
+        self.key = '-'.join([kind] + [config_name(conf) for conf in confs] + [hashlib.sha1(fields.encode()).hexdigest()[:10]])
+        self.path = DATA_PATH + MODELS_PATH + self.key + '/'
+
+    def manifest(self) -> dict:
+        """ Returns manifest listing saved versions, or an empty manifest if nothing has been saved. """
+
+        try:
+            with open(self.path + MANIFEST, 'r') as manifest:
+                return json.load(manifest)
+        except (OSError, ValueError):
+            return {'current': None, 'versions': []}
+
+    def current(self):
+        """ Returns details of the current version, or None if there is no compatible version. """
+
+        manifest = self.manifest()
+
+        for version in manifest['versions']:
+            if version['version'] == manifest['current']:
+                # Settings written by a different version of dedupe can't be read.
+                if version['dedupe'] != dedupe_version() or not os.path.exists(self.version_path(version['version']) + SETTINGS):
+                    return None
+                return version
+
+        return None
+
+    def version_path(self, version: int) -> str:
+        """ Returns path of folder containing the given version. """
+        return self.path + 'v' + str(version) + '/'
+
+    def training_file(self):
+        """ Returns path of labelled examples of the latest version (if any). Labelled examples are kept even if
+            the trained settings can't be reused. """
+
+        for version in reversed(self.manifest()['versions']):
+            path = self.version_path(version['version']) + TRAINING
+            if os.path.exists(path):
+                return path
+
+        return None
+
+    def settings_file(self):
+        """ Returns path of trained settings of the current version, or None if there is no compatible version. """
+
+        version = self.current()
+        return None if version is None else self.version_path(version['version']) + SETTINGS
+
+    def save(self, deduper) -> int:
+        """ Saves labelled examples and trained settings of a deduper as a new version. Returns the new version number. """
+
+        # Locked, so that two processes saving at the same time don't take the same version number or lose each other's
+        # versions from the manifest.
+        with file_lock(self.path + MANIFEST):
+            manifest = self.manifest()
+            number = max([version['version'] for version in manifest['versions']], default=0) + 1
+
+            os.makedirs(self.version_path(number), exist_ok=True)
+
+            with open(self.version_path(number) + TRAINING, 'w') as tf:
+                deduper.writeTraining(tf)
+
+            with open(self.version_path(number) + SETTINGS, 'wb') as sf:
+                deduper.writeSettings(sf)
+
+            # Manifest is updated last so that a partially saved version is never used.
+            manifest['versions'].append({'version': number,
+                                         'created': datetime.datetime.now().isoformat(timespec='seconds'),
+                                         'dedupe': dedupe_version()})
+            manifest['current'] = number
+
+            temp_path = self.path + MANIFEST + '.' + str(os.getpid()) + '.tmp'
+            with open(temp_path, 'w') as manifest_file:
+                json.dump(manifest, manifest_file, indent=2)
+            os.replace(temp_path, self.path + MANIFEST)
+
+        return number
+
+
+def config_name(conf) -> str:
+    """ Returns name of a configuration file without its folder or extension. """
+    return os.path.splitext(os.path.basename(conf.config_path))[0]
+
+
+def dedupe_version() -> str:
+    """ Returns installed version of dedupe. """
+
+    try:
+        return metadata.version('dedupe')
+    except metadata.PackageNotFoundError:
+        return 'unknown'
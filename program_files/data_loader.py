@@ -0,0 +1,174 @@
+"""
+Data Loader:
+
+Imports delimited files into data frames for every menu option. Files are profiled, pre-cleaned if configured and
+parsed with a multithreaded parser into Arrow backed string columns. Only the columns an option needs are imported,
+and two files are imported at the same time for options that compare files. Options that write whole records to their
+results can also get the rows of a file, which are read from a memory map when written rather than imported, or
+import a file a chunk of rows at a time.
+"""
+
+import codecs
+import pyarrow
+import pandas as pd
+
+from pyarrow import csv
+from pandas import DataFrame
+from concurrent.futures import ThreadPoolExecutor
+from program_files.helpers import EncodedStream, pre_clean, error
+from program_files.file_profiler import FileProfile, profile_file
+from program_files.row_index import FrameRows, map_rows
+
+# All columns are imported as (Arrow backed) strings to prevent type errors.
+STRING = pd.StringDtype('pyarrow')
+
+
+def load_data(conf, columns=None, optional=(), rows=False):
+    """ Imports the configured file. If columns is None, all columns (up to the configured column count) are imported.
+        Optional columns are imported as well if the file has them. Sets the encoding and delimiter of the configuration 
+        to those detected. If rows is True, returns a tuple of the data frame and the rows of the whole file. """
+
+    # Profile file to detect its encoding and delimiter. An unchanged file is read from the profile cache.
+    profile = profile_file(conf.path)
+
+    return read_profiled(conf, profile, columns, optional, rows)
+
+
+def load_chunks(conf, chunk_rows: int, columns=None):
+    """ Imports the configured file a chunk of rows at a time, so that only one chunk is in memory at once. Yields a 
+        data frame of the given columns (or every column, up to the configured column count, if None) for each chunk. 
+        Sets the encoding and delimiter of the configuration to those detected. """
+
+    profile = profile_file(conf.path)
+    usecols = select_columns(conf, profile.header, columns)
+
+    # Chunks are used as they are read, so the whole file must be known to decode before the first is read.
+    profile.wait()
+
+    conf.encoding = profile.encoding
+    conf.delimiter = profile.delimiter
+
+    if conf.pre_clean:
+        with pre_clean(conf.path, profile.encoding, conf.characters_to_clean) as source, \
+                read_pandas(source, profile, usecols, chunksize=chunk_rows) as reader:
+            yield from reader
+    else:
+        with read_pandas(conf.path, profile, usecols, chunksize=chunk_rows) as reader:
+            yield from reader
+
+
+def load_pair(conf_a, columns_a, conf_b, columns_b, optional=(), rows=False) -> tuple:
+    """ Imports the files of two configurations at the same time. Returns a tuple of both data frames, or of both 
+        (data frame, rows) tuples if rows is True. """
+
+    # Files are profiled first, one after the other, as profiling is quick and may need to report errors.
+    profile_a = profile_file(conf_a.path)
+    profile_b = profile_file(conf_b.path)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_a = executor.submit(read_profiled, conf_a, profile_a, columns_a, optional, rows)
+        future_b = executor.submit(read_profiled, conf_b, profile_b, columns_b, optional, rows)
+
+        return (future_a.result(), future_b.result())
+
+
+def read_profiled(conf, profile: FileProfile, columns=None, optional=(), rows=False):
+    """ Imports a profiled file, retrying once if background validation finds a better encoding. """
+
+    usecols = select_columns(conf, profile.header, columns, optional)
+
+    try:
+        data = read_file(conf, profile, usecols)
+    except UnicodeDecodeError:
+        # The encoding detected from a sample couldn't read the whole file. If validation found one that can, use it.
+        if not profile.wait():
+            raise
+        data = read_file(conf, profile, usecols)
+
+    # Update configuration with what was detected when profiling the file.
+    conf.encoding = profile.encoding
+    conf.delimiter = profile.delimiter
+
+    if not rows:
+        return data
+
+    # Rows of the whole file are read from a memory map if possible, otherwise every column is kept in memory.
+    header = select_columns(conf, profile.header)
+    mapped = map_rows(conf, profile, header, len(data))
+
+    if mapped is not None:
+        return (data, mapped)
+    elif usecols == header:
+        return (data, FrameRows(data))
+    else:
+        return (data, FrameRows(read_file(conf, profile, header)))
+
+
+def select_columns(conf, header: list, columns=None, optional=()) -> list:
+    """ Returns names of columns to import. Exits with an error if a requested column isn't in the file. """
+
+    # Import all columns, or the number of columns specified in the configuration.
+    if columns is None:
+        return header if conf.column_count is None else header[:conf.column_count]
+
+    # Optional columns are only imported if the file has them.
+    columns = list(columns) + [column for column in optional if column in header]
+
+    for column in columns:
+        if column not in header:
+            error('Could not find \'' + str(column) + '\' column in ' + conf.folder_name + ' data. ' +
+                  'Have you entered it correctly in the configuration file?')
+
+    # Columns are kept in the order they appear in the file and only imported once.
+    return [column for column in dict.fromkeys(header) if column in columns]
+
+
+def read_file(conf, profile: FileProfile, usecols: list) -> DataFrame:
+    """ Reads file into a data frame using the multithreaded Arrow parser. Pre-cleaned files are cleaned as they are
+        read and handed to the parser as UTF-8. """
+
+    try:
+        if conf.pre_clean:
+            with pre_clean(conf.path, profile.encoding, conf.characters_to_clean) as source:
+                table = read_arrow(EncodedStream(source), 'utf8', profile, usecols)
+        else:
+            # The Arrow parser only takes UTF-8 natively, anything else is decoded by Python as the file is read.
+            encoding = 'utf8' if codecs.lookup(profile.encoding).name == 'utf-8' else profile.encoding
+            table = read_arrow(conf.path, encoding, profile, usecols)
+    except pyarrow.ArrowInvalid:
+        # Files the Arrow parser won't accept (eg. ragged rows or repeated column names) are read by pandas instead.
+        return read_cleaned(conf, profile, usecols) if conf.pre_clean else read_pandas(conf.path, profile, usecols)
+
+    return table.to_pandas(types_mapper={pyarrow.string(): STRING}.get)
+
+
+def read_arrow(source, encoding: str, profile: FileProfile, usecols: list) -> pyarrow.Table:
+    """ Reads a file (or binary stream) in the given encoding with the Arrow parser. """
+
+    return csv.read_csv(source,
+                        read_options=csv.ReadOptions(encoding=encoding, use_threads=True),
+                        parse_options=csv.ParseOptions(delimiter=profile.delimiter, newlines_in_values=True),
+                        convert_options=csv.ConvertOptions(include_columns=usecols,
+                                                           column_types={column: pyarrow.string() for column in usecols},
+                                                           null_values=[],                 # Prevents empty cells being filled with NaN.
+                                                           strings_can_be_null=False,
+                                                           quoted_strings_can_be_null=False))
+
+
+def read_cleaned(conf, profile: FileProfile, usecols: list) -> DataFrame:
+    """ Reads file through a pre-cleaning stream. Characters are removed as the file is read, the file itself is not modified. """
+
+    with pre_clean(conf.path, profile.encoding, conf.characters_to_clean) as source:
+        return read_pandas(source, profile, usecols)
+
+
+def read_pandas(source, profile: FileProfile, usecols: list, chunksize=None) -> DataFrame:
+    """ Reads a file (or stream) with the pandas parser. If chunksize is given, returns a reader of chunks of that many rows. """
+
+    return pd.read_csv(source,
+                       sep=profile.delimiter,
+                       dtype=STRING,               # All column types set to string to prevent type errors.
+                       usecols=usecols,            # Only import columns that are needed.
+                       keep_default_na=False,      # Prevents pandas from filling empty cells with NaN.
+                       encoding=profile.encoding,  # Prevents decoding error when importing the data.
+                       chunksize=chunksize)
@@ -2,25 +2,45 @@
 Difference Detector: 
 
 Detects changes across two delimited files. For example, could check if the status flags have changed 
-beween ucas and scl data. 
+beween ucas and scl data. Rows are joined on their ids and every column observed for differences is compared at
+once, giving whether each column changed along with its old and new values.
+
+Also detects changes in a file since the last version of it was checked (eg. last week's extract), by comparing
+fingerprints of its records with those kept in a snapshot of the last version.
 """
 
+import os
 import pandas as pd
+
 from pandas import DataFrame
 
-from program_files.settings import DATA_PATH, DIFFERENCES, OUTPUT_PATH
-from program_files.helpers import open_config, info, get_file_path, get_encoding, pre_clean, get_delimiter, error
+from program_files.settings import CHANGES, DATA_PATH, DIFF_CHUNK_ROWS, DIFF_ENGINE, DIFF_MEMORY_LIMIT, DIFFERENCES, OUTPUT_PATH
+from program_files.helpers import open_config, info, get_file_path, error, warning
+from program_files.data_loader import load_chunks, load_pair
+from program_files.difference_store import DifferenceStore
+from program_files.snapshot_store import COLUMN, SnapshotStore, fingerprint
 
 def detect_differences():
   """ Detects differences between rows with the same ID (across two files) """
 
-# Ask user to select two configuration files from configuration folder.
+  # Ask user to select two configuration files from configuration folder.
   conf_a = open_config()
   conf_b = open_config()
 
   # Show that configuration files have been loaded successfully.
   info('Configuration files loaded successfully.', pre='\n')
 
+  # Get filepath for each file
+  conf_a.path = get_file_path(DATA_PATH + conf_a.folder_name, 'Please put ' + conf_a.folder_name + ' data in ' + conf_a.folder_name + ' folder. This folder must contain a single data file.')
+  conf_b.path = get_file_path(DATA_PATH + conf_b.folder_name, 'Please put ' + conf_b.folder_name + ' data in ' + conf_b.folder_name + ' folder. This folder must contain a single data file.')
+
+  # Find differences
+  find_differences(conf_a, conf_b)
+
+
+def find_differences(conf_a, conf_b, output_path=OUTPUT_PATH):
+  """ Detects differences between rows with the same ID across the files of two configurations. Used by the menu and by batch jobs. """
+
   # Check that two different configurations were selected 
   if conf_a.config_path == conf_b.config_path:
       error('You selected the same configuration twice (' + conf_a.config_path + '). Select two different config files.')
@@ -38,75 +58,191 @@ def detect_differences():
             '\tThis can be solved by adding/removing \'diff_columns\' in the respective configuration files\n' + 
             '\tsuch that both have the same number listed. ')
 
-  # Get filepath for each file
-  conf_a.path = get_file_path(DATA_PATH + conf_a.folder_name, 'Please put ' + conf_a.folder_name + ' data in ' + conf_a.folder_name + ' folder. This folder must contain a single data file.')
-  conf_b.path = get_file_path(DATA_PATH + conf_b.folder_name, 'Please put ' + conf_b.folder_name + ' data in ' + conf_b.folder_name + ' folder. This folder must contain a single data file.')
+  # Files too large to import are compared on disk instead, a chunk of rows at a time.
+  if DIFF_ENGINE == 'disk' or (DIFF_ENGINE == 'auto' and os.path.getsize(conf_a.path) + os.path.getsize(conf_b.path) > DIFF_MEMORY_LIMIT):
+    count = compare_on_disk(conf_a, conf_b, output_path + DIFFERENCES)
+  else:
+    # Import both files at the same time. Only the id column and columns observed for differences are imported.
+    (data_a, data_b) = load_pair(conf_a, [conf_a.id_column] + conf_a.diff_columns, conf_b, [conf_b.id_column] + conf_b.diff_columns)
+
+    # Blank line for menu formatting 
+    print()
+
+    diff = compare(conf_a, conf_b, data_a, data_b)
+    count = len(diff)
+
+    # Save differences to csv
+    diff.to_csv(output_path + DIFFERENCES, index=False)
+
+  # Info message for user
+  info('Complete! ' + str(count) + ' record(s) with differences found. Results saved to ' + output_path + DIFFERENCES)
+
+
+def compare(conf_a, conf_b, data_a: DataFrame, data_b: DataFrame) -> DataFrame:
+  """ Joins rows of two files on their ids and compares every pair of diff columns at once. Returns a row for every
+      pair of rows with a difference in any column, in the order of the first file. Each pair of columns is written
+      as a 'Changed-n' flag, followed by the value in the first file (old) and the value in the second file (new). """
+
+  (a_columns, b_columns) = joined_columns(conf_a, conf_b)
+
+  data_a = data_a[[conf_a.id_column] + conf_a.diff_columns].set_axis(['id'] + a_columns, axis=1)
+  data_b = data_b[[conf_b.id_column] + conf_b.diff_columns].set_axis(['id'] + b_columns, axis=1)
+
+  # Hash join on id. Only ids in both files are kept, an id repeated in either file is paired with every row of the other.
+  combined = data_a.merge(data_b, on='id', how='inner', sort=False)
+
+  warn_duplicates(len(combined) - combined['id'].nunique())
+
+  return differences(conf_a, conf_b, combined)
+
+
+def compare_on_disk(conf_a, conf_b, results_path: str) -> int:
+  """ Compares two files in a database on disk, so that neither file has to fit in memory. Writes the same results as
+      compare, a chunk of rows at a time. Returns the number of rows written. """
+
+  info('Comparing files on disk, as they are too large to compare in memory.', pre='\n')
+
+  (a_columns, b_columns) = joined_columns(conf_a, conf_b)
+  count = 0
+
+  with DifferenceStore() as store:
+    store.add('a', load_chunks(conf_a, DIFF_CHUNK_ROWS, [conf_a.id_column] + conf_a.diff_columns), [conf_a.id_column] + conf_a.diff_columns, a_columns)
+    store.add('b', load_chunks(conf_b, DIFF_CHUNK_ROWS, [conf_b.id_column] + conf_b.diff_columns), [conf_b.id_column] + conf_b.diff_columns, b_columns)
+
+    # Blank line for menu formatting 
+    print()
+
+    warn_duplicates(store.duplicates())
+
+    with open(results_path, 'w', newline='') as results_file:
+      for number, combined in enumerate(store.differing(a_columns, b_columns, DIFF_CHUNK_ROWS)):
+        diff = differences(conf_a, conf_b, combined)
+        diff.to_csv(results_file, index=False, header=number == 0)
+        count += len(diff)
+
+  return count
+
+
+def joined_columns(conf_a, conf_b) -> tuple:
+  """ Returns names given to the diff columns of each file when they are joined. Columns are renamed by position, as
+      both files can have columns with the same names. """
+  return (['a' + str(i) for i in range(len(conf_a.diff_columns))], ['b' + str(i) for i in range(len(conf_b.diff_columns))])
 
-  # Detect encoding for each file and update configurations 
-  conf_a.encoding = get_encoding(conf_a.path)
-  conf_b.encoding = get_encoding(conf_b.path)
 
-  # Pre-clean files as per configuration 
-  if conf_a.pre_clean:
-      pre_clean(conf_a.path, conf_a.encoding, conf_a.characters_to_clean)
-  
-  if conf_b.pre_clean:
-      pre_clean(conf_b.path, conf_b.encoding, conf_b.characters_to_clean)
+def warn_duplicates(duplicates: int) -> None:
+  """ Warns that ids are repeated, given the number of pairs of rows joined beyond one per id. """
+
+  if duplicates:
+    warning('Some ids appear more than once (' + str(duplicates) + ' extra pair(s) of rows). Each row is compared with every row of the other file with the same id.')
+
+
+def differences(conf_a, conf_b, combined: DataFrame) -> DataFrame:
+  """ Returns the rows of joined files (an id column, then the diff columns of each file) that differ in any column. """
+
+  (a_columns, b_columns) = joined_columns(conf_a, conf_b)
+
+  changed = DataFrame({a_column: combined[a_column].ne(combined[b_column]).to_numpy(dtype=bool) for a_column, b_column in zip(a_columns, b_columns)})
+  differs = changed.any(axis=1).to_numpy()
+
+  combined = combined[differs].reset_index(drop=True)
+  changed = changed[differs].reset_index(drop=True)
+
+  # Flag, old value and new value of every pair of columns. Values are named by side and position, as both files can
+  # have the same folder name and columns.
+  diff = {conf_a.id_column: combined['id']}
+  for count, (a_column, b_column) in enumerate(zip(conf_a.diff_columns, conf_b.diff_columns), 1):
+    diff['Changed-' + str(count)] = changed[a_columns[count - 1]]
+    diff[a_column + ' (Old-' + str(count) + ')'] = combined[a_columns[count - 1]]
+    diff[b_column + ' (New-' + str(count) + ')'] = combined[b_columns[count - 1]]
+
+  return DataFrame(diff)
+
+
+def detect_changes():
+  """ Detects changes to rows of a file since the last version of the file was checked. """
+
+  # Ask user to select a configuration file from configuration folder.
+  conf = open_config()
+
+  # Show that configuration file has been loaded successfully.
+  info('Configuration file loaded successfully.', pre='\n')
+
+  # Get filepath of file
+  conf.path = get_file_path(DATA_PATH + conf.folder_name, 'Please put ' + conf.folder_name + ' data in ' + conf.folder_name + ' folder. This folder must contain a single data file.')
+
+  # Find changes
+  find_changes(conf)
+
+
+def find_changes(conf, output_path=OUTPUT_PATH):
+  """ Detects rows added, removed or changed in the file of a configuration since the last snapshot of it, then saves
+      a snapshot of the file. Used by the menu and by batch jobs. """
+
+  # If id column and diff column(s) are not given this option cannot be run, exit. 
+  if conf.id_column == None or conf.diff_columns == [None]:
+    error('The configuration file you selected is missing a unique \'id_column\' or one or more \'diff_column\'')
+
+  store = SnapshotStore(conf)
+
+  # Fingerprint every row of the file, a chunk of rows at a time.
+  new = fingerprint(conf)
 
   # Blank line for menu formatting 
   print()
 
-  # Auto-detect delimiters being used in files
-  file_a_delimiter = get_delimiter(conf_a.path, encoding=conf_a.encoding)
-  file_b_delimiter = get_delimiter(conf_b.path, encoding=conf_b.encoding)
-
-  # Stores file contents present in configured folders into data frames
-  data_a: DataFrame = pd.read_csv(conf_a.path, 
-                                  sep=file_a_delimiter,
-                                  dtype=str,                  # All column types set to string to prevent type errors. 
-                                  usecols=conf_a.columns,     # Only import number of columns specified in config.
-                                  keep_default_na=False,      # Prevents pandas from filling empty cells with NaN.
-                                  encoding=conf_a.encoding)   # Prevents decoding error when importing the data. 
-  
-  data_b: DataFrame = pd.read_csv(conf_b.path, 
-                                  sep=file_b_delimiter,
-                                  dtype=str,
-                                  usecols=conf_b.columns,
-                                  keep_default_na=False,
-                                  encoding=conf_b.encoding) 
-
-  # If specified columns in conf_a are not in data_a, exit. 
-  for column in conf_a.diff_columns:
-      if not column in data_a.columns:
-          error('Could not find \'' + column + '\' column. Have you entered it correctly in the configuration file?')
-
-  for column in conf_b.diff_columns:
-      if not column in data_b.columns:
-          error('Could not find \'' + column + '\' column. Have you entered it correctly in the configuration file?')
-
-
-  # Remove uncommon records from data_a (Data that does not have a shared id/primary key in data_b) and vice versa
-  data_a_condensed = data_a[data_a[conf_a.id_column].isin(data_b[conf_b.id_column])].sort_values(conf_a.id_column)
-  data_b_condensed = data_b[data_b[conf_b.id_column].isin(data_a[conf_a.id_column])].sort_values(conf_b.id_column)
-
-  # When sorting by unique id, the index column is no longer sequential
-  # This removes the current index column and adds a new index colum with values 0 -> number of records. 
-  data_a_index_reset = data_a_condensed.reset_index(drop=True)
-  data_b_index_reset = data_b_condensed.reset_index(drop=True)
-
-  # Combine columns from data_b to the right of data_a
-  combined = pd.concat([data_a_index_reset, data_b_index_reset], axis=1)
-
-  # For every column in both datasetsto be considered for differences, 
-  for a_column, b_column in zip(conf_a.diff_columns, conf_b.diff_columns):
-    # Get data where current column in data_a not equal to current column in data_b
-    diff = combined.loc[combined[a_column].ne(combined[b_column])]
-    # Drop rows in the original dataset where differences have already been found. 
-    combined.drop(diff.index, inplace=True)
-
-  # Save differences to csv
-  diff.to_csv(OUTPUT_PATH + DIFFERENCES, index=False)
+  # Each id has one fingerprint, rows with an id that has already been seen are left out.
+  duplicates = new['id'].duplicated()
+  if duplicates.any():
+    warning(str(duplicates.sum()) + ' row(s) have an id that appears earlier in the file. Only the first row with each id is compared.')
+    new = new[~duplicates].reset_index(drop=True)
+
+  (old, saved) = store.previous()
+
+  if not saved:
+    info('Snapshot saved to ' + store.save(new))
+
+  if old is None:
+    info('No earlier snapshot of ' + conf.folder_name + ' data to compare with. The next version of the file will be compared with this one.')
+    return
+
+  changes = compare_snapshots(conf, old, new)
+  changes.to_csv(output_path + CHANGES, index=False)
 
   # Info message for user
-  info('Complete! Results saved to ' + OUTPUT_PATH + DIFFERENCES)
-  
\ No newline at end of file
+  counts = changes['Change'].value_counts()
+  info('Complete! ' + ', '.join(str(counts.get(change, 0)) + ' ' + change for change in ['added', 'removed', 'changed']) +
+       ' record(s). Results saved to ' + output_path + CHANGES)
+
+
+def compare_snapshots(conf, old: DataFrame, new: DataFrame) -> DataFrame:
+  """ Compares fingerprints of two versions of a file by their hashes alone. Returns a row for every id added, removed
+      or changed, with a 'Changed-n' flag of whether each diff column changed (named as by differences, with the
+      column's name). Changed rows may have changed in columns not observed for differences, in which case no diff
+      column is flagged. """
+
+  # Diff columns are only compared if both snapshots have them (eg. they may have been added to the configuration since).
+  # Flags are numbered by position in the configuration, so they can't clash with each other or the id column.
+  flags = {column: 'Changed-' + str(count) + ' (' + column + ')' for count, column in enumerate(conf.diff_columns, 1) if COLUMN + column in old.columns}
+
+  # Hash join on id of the ids in both versions, which have changed if their row hashes differ.
+  both = old.merge(new, on='id', how='inner', sort=False, suffixes=(' old', ' new'))
+  both = both[both['row old'] != both['row new']].reset_index(drop=True)
+
+  changed = DataFrame({conf.id_column: both['id'], 'Change': 'changed'})
+  for column, flag in flags.items():
+    changed[flag] = (both[COLUMN + column + ' old'] != both[COLUMN + column + ' new']).to_numpy()
+
+  removed = DataFrame({conf.id_column: missing_ids(old, new), 'Change': 'removed'})
+  added = DataFrame({conf.id_column: missing_ids(new, old), 'Change': 'added'})
+
+  changes = pd.concat([changed, removed, added], ignore_index=True)
+
+  # Columns can't have changed in rows that were added or removed.
+  return changes.fillna({flag: False for flag in flags.values()}).astype({flag: bool for flag in flags.values()})
+
+
+def missing_ids(data: DataFrame, other: DataFrame):
+  """ Returns ids of a data frame that aren't in another, in order. A left join is used as isin is slow on Arrow strings. """
+
+  joined = data[['id']].merge(other[['id']], on='id', how='left', sort=False, indicator=True)
+  return joined['id'][joined['_merge'] == 'left_only'].reset_index(drop=True)
@@ -0,0 +1,87 @@
+"""
+Difference Store:
+
+Joins two files on their ids in a SQLite database on disk, for files too large to compare in memory. Each file is
+copied into the database a chunk of rows at a time and indexed by id, then rows with the same id that
+differ are read back a chunk at a time. Memory used doesn't grow with the size of the files. The database is kept in
+the temporary folder and removed once the files have been compared.
+"""
+
+import os
+import sqlite3
+
+from pandas import DataFrame
+from program_files.data_loader import STRING
+from program_files.settings import DATA_PATH, TEMP_PATH
+
+
+class DifferenceStore():
+    def __init__(self) -> None:
+        """ Creates an empty database in the temporary folder. """
+
+        os.makedirs(DATA_PATH + TEMP_PATH, exist_ok=True)
+
+        self.path = DATA_PATH + TEMP_PATH + 'differences-' + str(os.getpid()) + '.db'
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+        self.connection = sqlite3.connect(self.path)
+
+        # The database is thrown away afterwards, so nothing is written to make it safe from crashes.
+        self.connection.execute('PRAGMA journal_mode = OFF')
+        self.connection.execute('PRAGMA synchronous = OFF')
+        self.connection.execute('PRAGMA temp_store = FILE')
+
+    def __enter__(self) -> 'DifferenceStore':
+        return self
+
+    def __exit__(self, *exception) -> None:
+        self.close()
+
+    def add(self, table: str, chunks, columns: list, names: list) -> None:
+        """ Copies chunks of a file into a table. The first of the given columns is stored as the id, the rest under
+            the given names. The table is then indexed by id. """
+
+        self.connection.execute('CREATE TABLE ' + table + ' (id TEXT, ' + ', '.join(name + ' TEXT' for name in names) + ')')
+        insert = 'INSERT INTO ' + table + ' VALUES (' + ', '.join('?' * (len(names) + 1)) + ')'
+
+        # Columns are turned into lists first, as iterating over rows of Arrow backed columns is slow.
+        for chunk in chunks:
+            self.connection.executemany(insert, zip(*[chunk[column].tolist() for column in columns]))
+
+        # Every column is in the index, so rows looked up by id are read from the index alone.
+        self.connection.execute('CREATE INDEX ' + table + '_id ON ' + table + ' (id, ' + ', '.join(names) + ')')
+
+        self.connection.commit()
+
+    def duplicates(self) -> int:
+        """ Returns the number of rows joined on id beyond one per id, ie. the number of extra pairs from repeated ids. """
+        return self.connection.execute('SELECT COUNT(*) - COUNT(DISTINCT a.id) FROM a INDEXED BY a_id CROSS JOIN b ON a.id = b.id').fetchone()[0]
+
+    def differing(self, a_columns: list, b_columns: list, chunk_rows: int):
+        """ Yields data frames of rows with the same id in both tables (an id column, then the columns of each table)
+            that differ in any column, in the order of the first table. At least one (possibly empty) data frame is
+            yielded. """
+
+        differs = ' OR '.join('a.' + a_column + ' IS NOT b.' + b_column for a_column, b_column in zip(a_columns, b_columns))
+
+        # Both tables are read in order of id, which is much faster than looking up ids in a random order. Rows that
+        # differ are then sorted back into the order of the first table.
+        cursor = self.connection.execute('SELECT a.id, ' + ', '.join(['a.' + column for column in a_columns] + ['b.' + column for column in b_columns]) +
+                                         ' FROM a INDEXED BY a_id CROSS JOIN b ON a.id = b.id WHERE ' + differs + ' ORDER BY a.rowid, b.rowid')
+
+        columns = ['id'] + a_columns + b_columns
+        rows = cursor.fetchmany(chunk_rows)
+
+        while True:
+            yield DataFrame(rows, columns=columns).astype(STRING)
+
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+
+    def close(self) -> None:
+        """ Closes and removes the database. """
+
+        self.connection.close()
+        os.remove(self.path)
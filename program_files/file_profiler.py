@@ -0,0 +1,234 @@
+"""
+File Profiler:
+
+Detects the BOM, encoding and delimiter of a delimited file from a bounded sample of its bytes. The whole file can
+optionally be validated in the background. Profiles are cached on disk, keyed by path, size and modification time,
+so unchanged files are not sniffed again on later runs.
+"""
+
+import os
+import csv
+import json
+import codecs
+import platform
+import threading
+
+from detect_delimiter import detect
+from program_files.helpers import info, warning, error, file_lock
+from program_files.settings import CACHE_PATH, DATA_PATH, ENCODINGS, PROFILE_CACHE, PROFILE_SAMPLE_SIZE
+
+# Byte order marks and the encoding that strips them. UTF-32 marks are checked first as they begin with the UTF-16 marks.
+BOMS = [(codecs.BOM_UTF32_LE, 'utf_32'),
+        (codecs.BOM_UTF32_BE, 'utf_32'),
+        (codecs.BOM_UTF8, 'utf_8_sig'),
+        (codecs.BOM_UTF16_LE, 'utf_16'),
+        (codecs.BOM_UTF16_BE, 'utf_16')]
+
+# Prevents two threads (eg. background validations) writing the cache at the same time. Other processes (eg. batch
+# jobs) are kept out by a file lock.
+cache_lock = threading.Lock()
+
+
+class FileProfile():
+    """ Holds what is known about how a file should be read. """
+
+    def __init__(self, file_path: str, encoding: str, delimiter: str, header: list, bom=False, validated=False) -> None:
+        self.path = file_path
+        self.encoding = encoding
+        self.delimiter = delimiter
+        self.header = header
+        self.bom = bom
+        self.validated = validated
+
+        # Background validation thread, if one has been started, and the encodings it found didn't work (all of
+        # them if the file couldn't be decoded at all). Results are reported by wait, from the thread that waits.
+        self.validation = None
+        self.failed = []
+        self.reported = False
+
+    def validate(self) -> None:
+        """ Starts a background thread that checks the whole file can be decoded using the detected encoding. """
+
+        # A daemon thread, so that the program can exit (eg. after an error) without waiting for the whole file.
+        if not self.validated and self.validation is None:
+            self.validation = threading.Thread(target=self.__validate, daemon=True)
+            self.validation.start()
+
+    def wait(self) -> bool:
+        """ Waits for background validation to finish and reports what it found. Returns True if the encoding was
+            changed by validation. """
+
+        if self.validation is None:
+            return False
+
+        self.validation.join()
+
+        # Results are only reported the first time.
+        if not self.reported:
+            self.reported = True
+
+            if not self.validated:
+                warning('Unable to decode the whole of ' + file_name(self.path) + '. This suggests that there is a serious issue with the file.', pre='\n')
+            elif self.failed:
+                warning('Could not read the whole of ' + file_name(self.path) + ' using ' + self.failed[0] + '. ' +
+                        self.encoding + ' will be used from now on.', pre='\n')
+
+        return bool(self.failed) and self.validated
+
+    def __validate(self) -> None:
+        """ Decodes the whole file in chunks. If the sampled encoding fails, the first encoding that works is used instead. """
+
+        candidates = [self.encoding] + [encoding for encoding in ENCODINGS if encoding != self.encoding]
+
+        # Nothing is printed from this thread, so messages don't interleave with the rest of the program's output.
+        for encoding in candidates:
+            if decodes(self.path, encoding):
+                self.encoding = encoding
+                self.validated = True
+                save_profile(self)
+                return
+
+            self.failed.append(encoding)
+
+        # Nothing could decode the file, forget the profile so the file is sniffed again next time.
+        forget_profile(self.path)
+
+
+def profile_file(file_path: str, validate=True) -> FileProfile:
+    """ Returns a profile of the given file, from the cache if the file has not changed since it was last profiled. """
+
+    profile = load_profile(file_path)
+
+    if profile is None:
+        profile = sniff(file_path)
+        save_profile(profile)
+
+    info('Using encoding: ' + profile.encoding + ' for ' + file_name(file_path))
+
+    # Check the whole file can be read with the sampled encoding while the program continues.
+    if validate:
+        profile.validate()
+
+    return profile
+
+
+def sniff(file_path: str) -> FileProfile:
+    """ Detects BOM, encoding, delimiter and header of a file from a sample of its first bytes. """
+
+    with open(file_path, 'rb') as file:
+        sample = file.read(PROFILE_SAMPLE_SIZE)
+        complete = file.read(1) == b''  # True if the sample is the whole file.
+
+    # A byte order mark decides the encoding outright.
+    bom = next((encoding for (mark, encoding) in BOMS if sample.startswith(mark)), None)
+    encodings = [bom] if bom is not None else ENCODINGS
+
+    # Use the first encoding that can decode the sample. An incomplete final character is allowed if the file continues.
+    for encoding in encodings:
+        try:
+            text = codecs.getincrementaldecoder(encoding)().decode(sample, final=complete)
+            break
+        except UnicodeDecodeError:
+            pass
+    else:
+        error('Unable to read file ' + file_path + ' using the following encodings ' + str(encodings) +
+              '\n\tThis suggests that there is a serious issue with the file. \n')
+
+    # Auto-detect delimiter and read column names from the first line.
+    first_line = text.splitlines()[0] if text else ''
+    delimiter = detect(first_line) or ','
+    header = next(csv.reader([first_line], delimiter=delimiter), [])
+
+    # A sample that is the whole file has been fully decoded already.
+    return FileProfile(file_path, encoding, delimiter, header, bom=bom is not None, validated=complete)
+
+
+def decodes(file_path: str, encoding: str) -> bool:
+    """ Returns True if the whole file can be decoded with the given encoding. Reads the file in chunks. """
+
+    decoder = codecs.getincrementaldecoder(encoding)()
+
+    try:
+        with open(file_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(PROFILE_SAMPLE_SIZE), b''):
+                decoder.decode(chunk)
+            decoder.decode(b'', final=True)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def cache_key(file_path: str) -> str:
+    """ Returns key used to identify a file in the profile cache. """
+    return os.path.abspath(file_path)
+
+
+def file_stamp(file_path: str) -> list:
+    """ Returns size and modification time of a file. If either changes the file must be profiled again. """
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def read_cache() -> dict:
+    """ Returns the contents of the profile cache, or an empty cache if there isn't one (or it can't be read). """
+
+    try:
+        with open(DATA_PATH + CACHE_PATH + PROFILE_CACHE, 'r') as cache:
+            return json.load(cache)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_cache(profiles: dict) -> None:
+    """ Writes the profile cache. Written to a temporary file first so a partially written cache is never read. """
+
+    os.makedirs(DATA_PATH + CACHE_PATH, exist_ok=True)
+
+    temp_path = DATA_PATH + CACHE_PATH + PROFILE_CACHE + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_path, 'w') as cache:
+        json.dump(profiles, cache, indent=2)
+    os.replace(temp_path, DATA_PATH + CACHE_PATH + PROFILE_CACHE)
+
+
+def load_profile(file_path: str):
+    """ Returns cached profile of the given file, or None if it hasn't been profiled or has changed since. """
+
+    entry = read_cache().get(cache_key(file_path))
+
+    if entry is None or entry.get('stamp') != file_stamp(file_path):
+        return None
+
+    return FileProfile(file_path, entry['encoding'], entry['delimiter'], entry['header'],
+                       bom=entry['bom'], validated=entry['validated'])
+
+
+def save_profile(profile: FileProfile) -> None:
+    """ Adds (or updates) a profile in the cache. """
+
+    with cache_lock, file_lock(DATA_PATH + CACHE_PATH + PROFILE_CACHE):
+        profiles = read_cache()
+        profiles[cache_key(profile.path)] = {'stamp': file_stamp(profile.path),
+                                             'encoding': profile.encoding,
+                                             'delimiter': profile.delimiter,
+                                             'header': profile.header,
+                                             'bom': profile.bom,
+                                             'validated': profile.validated}
+        write_cache(profiles)
+
+
+def forget_profile(file_path: str) -> None:
+    """ Removes a file from the cache. """
+
+    with cache_lock, file_lock(DATA_PATH + CACHE_PATH + PROFILE_CACHE):
+        profiles = read_cache()
+        if profiles.pop(cache_key(file_path), None) is not None:
+            write_cache(profiles)
+
+
+def file_name(file_path: str) -> str:
+    """ Returns the name of a file from its path, depending on system. """
+
+    if platform.system() == 'Windows':
+        return file_path.split('\\')[-1]
+    else:
+        return file_path.split('/')[-1]
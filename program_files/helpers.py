@@ -4,42 +4,200 @@ File Helpers:
 Contains helpful functions that are frequently used across multiple files. 
 """
 
+import io
 import os
 import sys
 import glob
 import shutil
 import platform
 
+from contextlib import contextmanager
 from colorama import Fore, Back
-from detect_delimiter import detect
 from colorama.initialise import deinit
 from json.decoder import JSONDecodeError
 from program_files.menu import SingleSelectionMenu
 from program_files.configuration_manager import Configuration
-from program_files.settings import CONFIG_PATH, DATA_PATH, TEMP_PATH, TRAINING_PATH
+from program_files.settings import CLEAN_CHUNK_SIZE, CONFIG_PATH, DATA_PATH, TEMP_PATH
 
+if platform.system() == 'Windows':
+    import msvcrt
+else:
+    import fcntl
 
-def pre_clean(file_path, encoding, to_remove) -> None:
-    """ Removes given characters from the file to prevent errors during importation. """
 
-    info('Pre-Cleaning ' + file_path.split('/')[-1], fin='')  # Prints info message and gets filename from file path.
+# True when running without a user, eg. batch jobs. Errors are raised instead of exiting and nothing prompts for input.
+headless = False
 
-    with open(file_path, 'r', encoding=encoding) as file:  # Opens file with appropriate encoding (for read)
-        
-        # Initialise f_cleaned to retain changes made in each iteration of the loop.
-        f_cleaned = file
-        
-        # For every character in the list of characters to remove. 
-        for character in to_remove:
-            # Seek to start of file 
-            file.seek(0)
-            # Replace all occurences of the character with nothing. 
-            f_cleaned = file.read().replace(character, '') 
+# Number of cores to score record pairs with, given on the command line (overrides configuration files), and the
+# number of jobs sharing the machine's cores when no number is given.
+cores = None
+core_share = 1
 
-    with open(file_path, 'w', encoding=encoding) as file:  # Opens file with appropriate encoding (for write)
-        file.write(f_cleaned)  # Writes cleaned file to file
 
-    print(' (Finished)')
+class ToolError(Exception):
+    """ Raised by error() when running headless, so that the failure can be recorded and other jobs carry on. """
+
+
+def set_headless() -> None:
+    """ Marks the current process as running without a user. """
+    global headless
+    headless = True
+
+
+def is_headless() -> bool:
+    """ Returns True if the current process is running without a user. """
+    return headless
+
+
+def set_cores(number=None, share=1) -> None:
+    """ Sets number of cores to use for scoring, or the number of jobs sharing available cores if not given. """
+    global cores, core_share
+    cores = number
+    core_share = max(share, 1)
+
+
+def get_cores() -> tuple:
+    """ Returns number of cores given on the command line (or None) and the number of jobs sharing available cores. """
+    return (cores, core_share)
+
+
+@contextmanager
+def file_lock(file_path: str):
+    """ Holds an exclusive lock on a file shared between processes (eg. a cache used by batch jobs running at the same
+        time) until the block ends, waiting for any other process holding it. The lock is taken on a separate file 
+        next to it, as shared files are replaced rather than written in place. """
+
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+
+    with open(file_path + '.lock', 'a+b') as lock_file:
+        if platform.system() == 'Windows':
+            lock_file.seek(0)
+
+            # Windows gives up after trying for 10 seconds, so keep trying until the lock is free.
+            while True:
+                try:
+                    msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+
+            try:
+                yield
+            finally:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class PreCleaner():
+    """ Read-only text stream that removes configured characters from a file as it is read. 
+        The source file is never modified, only the text handed to the reader is cleaned. """
+
+    def __init__(self, file_path: str, encoding: str, to_remove: list, chunk_size=CLEAN_CHUNK_SIZE) -> None:
+        self.file = open(file_path, 'r', encoding=encoding, newline='')
+        self.chunk_size = chunk_size
+
+        # Translation table mapping every character to be removed to None, so all are stripped in one pass.
+        self.table = str.maketrans({character: None for character in ''.join(to_remove)})
+
+        # Cleaned text that has been read from the file but not yet handed to the reader.
+        self.buffer = ''
+
+    def read(self, size=-1) -> str:
+        """ Returns up to size cleaned characters, or the rest of the file if size is negative. """
+
+        if size is None or size < 0:
+            text = self.buffer + self.file.read().translate(self.table)
+            self.buffer = ''
+            return text
+
+        # Top up the buffer one chunk at a time. Chunks can shrink once cleaned, so keep going until filled or at the end.
+        while len(self.buffer) < size:
+            chunk = self.file.read(max(size, self.chunk_size))
+            if chunk == '':
+                break
+            self.buffer += chunk.translate(self.table)
+
+        text, self.buffer = self.buffer[:size], self.buffer[size:]
+        return text
+
+    def readline(self, size=-1) -> str:
+        """ Returns the next cleaned line (including its line ending). """
+
+        # If a previous read left a complete line in the buffer, hand that back first.
+        end = self.buffer.find('\n') + 1
+        if end > 0:
+            line, self.buffer = self.buffer[:end], self.buffer[end:]
+        else:
+            line = self.buffer + self.file.readline().translate(self.table)
+            self.buffer = ''
+
+        if size is not None and size >= 0 and len(line) > size:
+            line, self.buffer = line[:size], line[size:]
+
+        return line
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        line = self.readline()
+        if line == '':
+            raise StopIteration
+        return line
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class EncodedStream(io.RawIOBase):
+    """ Read-only binary stream of a text stream (eg. a PreCleaner) encoded as UTF-8, for parsers that only read bytes. """
+
+    def __init__(self, text_stream, chunk_size=CLEAN_CHUNK_SIZE) -> None:
+        self.text_stream = text_stream
+        self.chunk_size = chunk_size
+
+        # Encoded text that has been read from the stream but not yet handed to the reader.
+        self.buffer = bytearray()
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, target) -> int:
+        """ Fills target with up to its length of encoded bytes. Returns the number of bytes, zero at the end of the stream. """
+
+        while len(self.buffer) < len(target):
+            text = self.text_stream.read(self.chunk_size)
+            if text == '':
+                break
+            self.buffer += text.encode('utf-8')
+
+        size = min(len(target), len(self.buffer))
+        target[:size] = self.buffer[:size]
+        del self.buffer[:size]
+
+        return size
+
+
+def pre_clean(file_path, encoding, to_remove) -> PreCleaner:
+    """ Returns a stream of the file with the given characters removed, to prevent errors during importation. 
+        Cleaning happens as the data is read, the original file is left untouched. """
+
+    info('Pre-Cleaning ' + file_path.split('/')[-1] + ' as it is imported.')  # Prints info message and gets filename from file path.
+
+    return PreCleaner(file_path, encoding, to_remove)
 
 
 def open_config() -> dict:
@@ -107,8 +265,12 @@ def try_again() -> None:
 
 
 def error(msg: str, fin=None, pre='', post='') -> None:
-    """ Prints supplied error message and sys.exits(1) """
+    """ Prints supplied error message and sys.exits(1). Raises ToolError instead when running headless. """
     print(coloured(pre + '[ERROR] ', Fore.RED) + msg + post, end=fin)
+
+    if headless:
+        raise ToolError(msg)
+
     cleanup_and_exit()
 
 
@@ -139,8 +301,6 @@ def cleanup_and_exit(prompt=True) -> None:
     deinit()
 
     # Remove temporary directories
-    if os.path.exists(DATA_PATH + TRAINING_PATH):
-        shutil.rmtree(DATA_PATH + TRAINING_PATH)
     if os.path.exists(DATA_PATH + TEMP_PATH):
         shutil.rmtree(DATA_PATH + TEMP_PATH)
 
@@ -161,40 +321,3 @@ def get_file_path(path: str, msg: str) -> str:
             try_again()                     # Gets user to enter 't' to try again, or 'e' to exit the program.
         else:
             return folder_contents[0]       # [0] refers to first element of list of folder contents. This is the path to the one and only file in the folder.
-
-
-def get_delimiter(file_path:str, encoding=None) -> str:
-    """ Opens, reads and closes a file automatically detecting the delimiter being used. """
-
-    if encoding is not None:
-        with open(file_path, encoding=encoding) as file:
-            return detect(file.readline())
-    else:
-        with open(file_path) as file:
-            return detect(file.readline())
-
-
-def get_encoding(file_path: str) -> str:
-    """ Attepmts to determine a suitable encoding for a file by opening and reading it with potential encoding. """
-
-    # List of potential encodings 
-    encodings = ['utf_8', 'Windows-1252', 'iso8859_15', 'ascii', 'utf_16', 'utf_32']
-
-    # loop through, return encoding that works or quit if no encoding is suitable
-    for encoding in encodings:
-        try:
-            with open(file_path, encoding=encoding) as file:
-                file.read()
-
-                if platform.system() == 'Windows':
-                    info('Using encoding: ' + encoding + ' for ' + file_path.split('\\')[-1])
-                else:
-                    info('Using encoding: ' + encoding + ' for ' + file_path.split('/')[-1])
-                
-                return encoding
-        except Exception: # Not specific to account for UnicodeDecode error and others (potentially)
-            pass
-
-    error('Unable to read file ' + file_path + ' using the following encodings ' + str(encodings) + 
-          '\n\tThis suggests that there is a serious issue with the file. \n')
-          
\ No newline at end of file
@@ -0,0 +1,155 @@
+"""
+Link Cache:
+
+Remembers the result of every link checked, so that links checked recently aren't requested again on later runs. How
+long a result is reused depends on its class (see LINK_CACHE_DAYS in settings), eg. working links are reused for longer
+than links that got no response, as those may only be down for a while.
+
+While links are checked, each result is also appended to a checkpoint as soon as it is found. If a run stops before it
+finishes (eg. it crashes or is interrupted), the next run of the same file carries on from the checkpoint, so only links
+that hadn't been checked are requested.
+"""
+
+import os
+import json
+import time
+
+from contextlib import ExitStack
+from program_files.helpers import file_lock
+from program_files.settings import CACHE_PATH, DATA_PATH, LINK_CACHE, LINK_CACHE_DAYS
+
+DAY = 24 * 60 * 60
+
+
+class LinkCheckpoint():
+    def __init__(self, path: str, source) -> None:
+        """ Opens checkpoint at the given path. Results are carried on from the checkpoint if it was written by a run 
+            with the same source (eg. the same file and columns), otherwise it is started again. """
+
+        self.path = path
+        self.results = {}
+
+        # Held until the checkpoint is closed, so two runs (eg. batch jobs with the same output folder) can't write
+        # the same checkpoint. A second run waits, then carries on from the first.
+        self.lock = ExitStack()
+        self.lock.enter_context(file_lock(path))
+
+        entries = read_lines(path)
+
+        if entries[:1] == [{'source': source}]:
+            self.results = dict(entries[1:])
+
+        # Results carried on are written again, so nothing is appended after a partly written entry.
+        self.file = open(path, 'w')
+        self.write({'source': source})
+
+        for link, result in self.results.items():
+            self.write([link, result])
+
+    def add(self, link: str, result) -> None:
+        """ Appends result of a link. """
+
+        self.results[link] = result
+        self.write([link, result])
+
+    def write(self, entry) -> None:
+        # Each entry is flushed as it is written, so it is kept if the program stops.
+        self.file.write(json.dumps(entry) + '\n')
+        self.file.flush()
+
+    def sync(self) -> None:
+        """ Makes sure results written so far are stored on disk, eg. after each chunk of rows. """
+        os.fsync(self.file.fileno())
+
+    def close(self, finished=False) -> None:
+        """ Closes the checkpoint, removing it if the run has finished. """
+
+        self.file.close()
+
+        if finished:
+            os.remove(self.path)
+
+        self.lock.close()
+
+
+class LinkCache():
+    def __init__(self, file_name=LINK_CACHE, days=LINK_CACHE_DAYS) -> None:
+        """ Initialises cache kept in the given file of the cache folder, reusing results for the given number of days. """
+
+        self.path = DATA_PATH + CACHE_PATH + file_name
+        self.days = days
+
+        # Result of each link and when it was found (seconds since the epoch), by link.
+        self.results = read_results(self.path)
+        self.added = {}
+
+    def fresh(self, links) -> dict:
+        """ Returns results of the given links that are recent enough to reuse, by link. """
+
+        now = time.time()
+        fresh = {}
+
+        for link in links:
+            entry = self.results.get(link)
+            if entry is not None and now - entry[1] < self.days.get(result_class(entry[0]), 0) * DAY:
+                fresh[link] = entry[0]
+
+        return fresh
+
+    def add(self, results: dict) -> None:
+        """ Adds results that have just been found, by link. """
+
+        now = time.time()
+
+        for link, result in results.items():
+            self.results[link] = self.added[link] = [result, now]
+
+    def save(self) -> None:
+        """ Writes results added to the cache. Results written by other processes since the cache was read are kept,
+            and results too old to be reused are removed. """
+
+        now = time.time()
+
+        # Locked, so results written by another process between reading and replacing the cache aren't lost.
+        with file_lock(self.path):
+            results = read_results(self.path)
+            results.update(self.added)
+            results = {link: entry for link, entry in results.items() if now - entry[1] < self.days.get(result_class(entry[0]), 0) * DAY}
+
+            # Written to a temporary file first so a partially written cache is never read.
+            temp_path = self.path + '.' + str(os.getpid()) + '.tmp'
+            with open(temp_path, 'w') as cache:
+                json.dump(results, cache)
+            os.replace(temp_path, self.path)
+
+        self.added = {}
+
+
+def read_results(path: str) -> dict:
+    """ Returns the contents of a cache, or an empty cache if there isn't one (or it can't be read). """
+
+    try:
+        with open(path, 'r') as cache:
+            return json.load(cache)
+    except (OSError, ValueError):
+        return {}
+
+
+def read_lines(path: str) -> list:
+    """ Returns the entries of a checkpoint, or an empty list if there isn't one. A partly written last entry is ignored. """
+
+    entries = []
+
+    try:
+        with open(path, 'r') as checkpoint:
+            for line in checkpoint:
+                entries.append(json.loads(line))
+    except (OSError, ValueError):
+        pass
+
+    return entries
+
+
+def result_class(result) -> str:
+    """ Returns class of a result, eg. '2xx' for status code 200, or the result itself for link check codes. """
+    return str(result // 100) + 'xx' if isinstance(result, int) else result
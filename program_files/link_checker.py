@@ -4,29 +4,25 @@ Link Checker:
 Automatically tests links in a file. 
 """
 
-import re
-import json
-import requests
-import pandas as pd
-import concurrent.futures
-
-from pandas import DataFrame
-from requests.models import Response
-from json.decoder import JSONDecodeError
-from program_files.helpers import info, open_config, pre_clean, get_file_path, get_delimiter, get_encoding, error
-from program_files.settings import DATA_PATH, EMPTY, NO_RESPONSE, REQUEST_TIMEOUT, VERIFY_CERT, WAYBACK_MACHINE, WBM_API, USE_WBM, LINKS_CHECKED, OUTPUT_PATH
-
-# Disable insecure request warning, caused by setitng verify=False
-import urllib3
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+import os
+
+from program_files.helpers import info, open_config, get_file_path, error
+from program_files.data_loader import load_chunks
+from program_files.file_profiler import cache_key, file_stamp
+from program_files.link_cache import LinkCache, LinkCheckpoint
+from program_files.link_engine import LinkError, Scheduler, lookup_all, request_all
+from program_files.link_telemetry import LinkTelemetry
+from program_files.link_validator import format_links
+from program_files.settings import DATA_PATH, EMPTY, INVALID, NO_RESPONSE, USE_WBM, WBM_CACHE, WBM_CACHE_DAYS, LINKS_CHECKED, LINK_CHECKPOINT, LINK_CHUNK_ROWS, LINK_REPORT, OUTPUT_PATH
 
 # Set Warnings 
 import logging 
-logging.getLogger("requests").setLevel(logging.WARNING)
-logging.getLogger("urllib3").setLevel(logging.ERROR)
+logging.getLogger("aiohttp").setLevel(logging.ERROR)
 
 
 def check_links():
+    """ Checks links in a file. """
+
     # Get file configuration 
     conf = open_config()
 
@@ -36,163 +32,153 @@ def check_links():
     # Get filepath of file 
     conf.path = get_file_path(DATA_PATH + conf.folder_name, 'Please put ' + conf.folder_name + ' data in ' + conf.folder_name + ' folder. This folder must contain a single data file.')
 
-    # Detect encoding for file and update configuration
-    conf.encoding = get_encoding(conf.path)
+    # Check links
+    verify_links(conf)
 
-    # Pre-clean file as per configuration 
-    if conf.pre_clean:
-        pre_clean(conf.path, conf.encoding, conf.characters_to_clean)
+
+def verify_links(conf, output_path=OUTPUT_PATH):
+    """ Checks links in the url columns of the file of a configuration. Used by the menu and by batch jobs. The file is
+        imported, checked and written a chunk of rows at a time, and results are checkpointed as they are found, so a
+        run that stops carries on from where it got to when run again. """
 
     # Print blank line for menu formatting 
     print()
 
-    # Auto-detect delimiter used in file
-    file_delimiter = get_delimiter(conf.path, encoding=conf.encoding)
-
-    # Stores file contents present in configured folders into data frame
-    data: DataFrame = pd.read_csv(conf.path, 
-                                  sep=file_delimiter,
-                                  dtype=str,
-                                  usecols=conf.columns,
-                                  keep_default_na=False,
-                                  encoding=conf.encoding) 
-
     # If no column has been specified in config, exit. 
     if conf.url_columns == None or conf.url_columns == [None]:
         error('No url_column(s) specified in selected configuration.')
 
-    # If specified column is not in data, exit. 
-    for column in conf.url_columns:
-        if not column in data.columns:
-            error('Could not find ' + column + '. Have you entered it correctly in the configuration file?')
+    # Results of a run of the same file and columns that didn't finish are carried on.
+    checkpoint = LinkCheckpoint(output_path + LINK_CHECKPOINT, {'file': cache_key(conf.path), 'stamp': file_stamp(conf.path), 'columns': conf.url_columns})
+
+    if checkpoint.results:
+        info('Carrying on from an earlier run, ' + str(len(checkpoint.results)) + ' link(s) already checked.')
 
     # Tell user that link checking has started. 
-    info('Link checking has started, this may take a while. (~2min per 1k urls)')
+    info('Link checking has started, this may take a while for sites that are slow to respond.')
 
-    # Validate links in all url column
-    for count, column in enumerate(conf.url_columns, 1):
+    telemetry = LinkTelemetry()
+    cache = LinkCache()
 
-        # Add additional column(s) to data to show result of link checking 
-        data.insert(loc=data.columns.get_loc(column), column='Link Check-' + str(count), value='')
+    # Timeouts learnt and hosts stopped are kept from one chunk to the next.
+    scheduler = Scheduler(telemetry)
 
-        # Get list of links 
-        links = data[column].tolist()
+    # Results are written to a temporary file, which replaces the results file once every row has been written.
+    temp_path = output_path + LINKS_CHECKED + '.tmp'
 
-        # Format links (remove http, https, blank spaces)
-        formatted_links = format_links(links)
+    with open(temp_path, 'w', newline='') as results_file:
+        # Every column is imported as whole records are written to the results.
+        for number, data in enumerate(load_chunks(conf, LINK_CHUNK_ROWS)):
 
-        # Run requests concurrently and get responses
-        responses = run_requests(formatted_links)
+            # If specified column is not in data, exit. 
+            for column in conf.url_columns:
+                if not column in data.columns:
+                    error('Could not find ' + column + '. Have you entered it correctly in the configuration file?')
 
-        # Create dictionary from original list of links
-        links_dict = dict(enumerate(formatted_links))
+            # Format links in every url column, marking values that can't be links as invalid
+            formatted_links = {column: format_links(data[column]).tolist() for column in conf.url_columns}
 
-        # If there are as many formatted links as there are responses (there should always be)
-        if len(formatted_links) == len(responses):
-            # for every link 
-            for k in links_dict.keys():
-                # Put response codes in correct position 
-                links_dict[k] = responses[k].status_code if isinstance(responses[k], Response) else responses[k]
-        else:
-            error('The number of responses differs from the number of original requests.')
+            # Each link is only checked once, however many rows and columns it appears in. Invalid links aren't requested.
+            links = list(dict.fromkeys(link for column in conf.url_columns for link in formatted_links[column] if link not in ('', INVALID)))
 
-        # Add responses to link check column 
-        data['Link Check-' + str(count)] = links_dict.values()
+            invalid = sum(formatted_links[column].count(INVALID) for column in conf.url_columns)
+            telemetry.invalid += invalid
 
+            if invalid:
+                info(str(invalid) + ' value(s) are not valid links, marked ' + INVALID + '.')
 
-    # Write new data to file 
-    data.to_csv(OUTPUT_PATH + LINKS_CHECKED, index=False)
+            # Run requests concurrently and get responses, measuring how long they take
+            responses = run_requests(links, telemetry, cache, checkpoint, scheduler)
+
+            # Add additional column(s) to data to show result of link checking, filled in from the response to each link
+            for count, column in enumerate(conf.url_columns, 1):
+                data.insert(loc=data.columns.get_loc(column), column='Link Check-' + str(count),
+                            value=[responses.get(link, EMPTY if link == '' else INVALID) for link in formatted_links[column]])
+
+            # Write chunk to file, with the header before the first chunk
+            data.to_csv(results_file, index=False, header=number == 0)
+
+    os.replace(temp_path, output_path + LINKS_CHECKED)
+    checkpoint.close(finished=True)
 
     # Info message for user
-    info('Complete! Results saved to ' + OUTPUT_PATH + LINKS_CHECKED)
+    info('Complete! Results saved to ' + output_path + LINKS_CHECKED)
 
+    # Write measurements of the run next to the results
+    telemetry.save(output_path + LINK_REPORT)
 
-def run_requests(links):
-    """ Executes the lists of requests concurrently and returns responses (not in order). """
 
-    # Empty list to store responses 
-    responses = {}
+def run_requests(links, telemetry, cache, checkpoint, scheduler):
+    """ Checks every link and returns the response code of each, by link. Links checked earlier in the run (or in a
+        run that didn't finish) are read from the checkpoint, and links checked recently are read from the cache.
+        Links are requested with the scheduler of the run. """
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=25) as exec:
-        future_to_url = {exec.submit(setup_request, url): (index, url) for (index, url) in enumerate(links)}
-        for future in concurrent.futures.as_completed(future_to_url):
+    responses = {link: checkpoint.results[link] for link in links if link in checkpoint.results}
 
-            (index, url) = future_to_url[future]
-            
-            try:
-                responses[index] = future.result()  
-            except Exception:
-                info('Could not get a response from ' + url)
-                responses[index] = available_on_wbm(url)
+    # Links from the checkpoint have already been counted, if they were checked in this run.
+    links = [link for link in links if link not in responses]
+    fresh = cache.fresh(links)
+    responses.update(fresh)
 
-    return responses
+    telemetry.links += len(links)
+    telemetry.cached += len(fresh)
 
+    to_request = [link for link in links if link not in fresh]
 
-def available_on_wbm(url):
-    """ Checks if a given url has an archived snapshot on the wayback machine (internet archive). """
+    info(str(len(links)) + ' new unique link(s) found, ' + str(len(fresh)) + ' checked recently. Requesting ' + str(len(to_request)) + '.')
 
-    # If option disabled in settings file, return None
-    if not USE_WBM:
-         return NO_RESPONSE
+    # Each result is checkpointed as soon as it is final.
+    def done(index, response):
+        checkpoint.add(to_request[index], NO_RESPONSE if isinstance(response, LinkError) else response)
 
-    # Send request to API and store content
-    response_content =requests.get(WBM_API + url).content
-    
-    # Attempt to parse response content
-    try:
-        response_json = json.loads(response_content)
-    except JSONDecodeError:
-        info('Response from wayback machine api contained invalid JSON. (' + response_content + ')')
+    for index, response in request_all(to_request, telemetry, done, scheduler).items():
+        if isinstance(response, LinkError):
+            info('Could not get a response from ' + to_request[index] + ' (' + str(response) + ')')
+            response = NO_RESPONSE
 
-    # Extract fields from JSON response, by default all are set to empty dicts
-    snapshots = response_json.get('archived_snapshots', {})
-    closest_snapshot = snapshots.get('closest', {})
-    snapshot_status = closest_snapshot.get('status', {})
+        responses[to_request[index]] = response
 
-    # If snapshots is an empty dict then no snapshot is available for the respective site 
-    if snapshots == {}:
-        return NO_RESPONSE
-    # Othweise, if the status of the available snapshot is 200, return WBM to show its availability 
-    else:
-        return WAYBACK_MACHINE if snapshot_status == '200' else NO_RESPONSE
+    # Cached links are checkpointed too, so later chunks find them in the checkpoint.
+    for link in fresh:
+        checkpoint.add(link, fresh[link])
 
+    checkpoint.sync()
 
-def setup_request(url):
-    """ Sets up and returns web request. """
+    cache.add({link: responses[link] for link in to_request})
+    cache.save()
 
-    # If the url is blank/empty, return empty string
-    if url == '':
-        return EMPTY
+    # Links that got no response are looked up on the wayback machine, if enabled in the settings file.
+    if USE_WBM:
+        responses.update(check_archived([link for link, response in responses.items() if response == NO_RESPONSE]))
 
-    # Otherwise return request
-    else: 
-        return requests.get(url, 
-                            verify=VERIFY_CERT, 
-                            timeout=REQUEST_TIMEOUT)
+    telemetry.record_results({link: responses[link] for link in links})
+
+    return responses
 
 
-def format_links(links):
-    """ Formats links. Removes whitespace, http:// and https:// and attempts to correct some errors. """
+def check_archived(links):
+    """ Checks if links have an archived snapshot on the wayback machine (internet archive). Returns WAYBACK_MACHINE
+        or NO_RESPONSE for each link, by link. Links looked up recently are read from the cache. """
 
-    # For every link in list of links
-    for i in range(len(links)):
+    cache = LinkCache(WBM_CACHE, WBM_CACHE_DAYS)
+    results = cache.fresh(links)
 
-        # Convert to lower case and remove leading and trailing whitespace
-        links[i] = links[i].lower().strip()
+    to_lookup = [link for link in links if link not in results]
 
-        ## Unsure about regular expressions? Try and copy the expression (eg, ^\s*$) into this site https://regex101.com/ for an explanation
-        # If link consists of only whitespace, set to empty string
-        links[i] = re.sub(r'^\s*$', '', links[i])
+    if to_lookup:
+        info('Looking up ' + str(len(to_lookup)) + ' link(s) on the wayback machine.')
 
-        # Remove https and http from start, account for possible :; and /\ typo
-        links[i] = re.sub(r'https{0,1}(:|;)\/\/', '', links[i])
+    found = {}
 
-        # If a link doesnt now begin with www. add it to the start 
-        if not links[i].startswith('www.') and links[i] != '':
-            links[i] = 'www.' + links[i]
+    for index, result in lookup_all(to_lookup).items():
+        if isinstance(result, LinkError):
+            # Failed lookups aren't cached, so they are tried again next time.
+            info('Could not look up ' + to_lookup[index] + ' on the wayback machine (' + str(result) + ')')
+            results[to_lookup[index]] = NO_RESPONSE
+        else:
+            results[to_lookup[index]] = found[to_lookup[index]] = result
 
-        # Append http:// to the start of each 
-        if links[i] != '':
-            links[i] = 'http://' + links[i]
+    cache.add(found)
+    cache.save()
 
-    return links
+    return results
@@ -0,0 +1,451 @@
+"""
+Link Engine:
+
+Requests every link of a batch concurrently from a single event loop. Connections are pooled and kept alive, with a
+cap on the number open to any one host, so that thousands of requests can be in flight without flooding a server.
+Only the status of each link is needed, so a HEAD request is tried first. Servers that don't answer HEAD properly are
+sent a GET instead, which is closed as soon as the status line and headers arrive, so page bodies are never downloaded.
+
+Host names are resolved first, all at once and with a short timeout. Links to hosts that don't resolve (eg. domains
+that no longer exist) fail straight away, without tying up a connection, and requests use the addresses found.
+
+How long a request waits for a response is set from the latency of responses seen so far, so that a few dead servers
+don't hold up a batch for the full timeout. Links that fail for reasons that may not last (eg. timeouts, dropped
+connections or servers saying they are busy) are retried with the full timeout, with backoff, once every other link
+has been checked. Hosts that fail several times in a row stop being requested, and only one of their links is tried
+on each retry until they respond again.
+
+Links that got no response can then be looked up on the wayback machine, as a separate stage with its own, much
+smaller, limits so that the archive's API isn't flooded.
+"""
+
+import time
+import yarl
+import numpy
+import socket
+import asyncio
+import aiohttp
+
+from aiohttp.abc import AbstractResolver
+from collections import Counter, defaultdict
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from program_files.link_telemetry import LinkTelemetry
+from program_files.settings import BREAKER_FAILURES, DNS_MAX_LOOKUPS, DNS_TIMEOUT, EMPTY, MAX_PER_HOST, MAX_REQUESTS, \
+                                   MIN_TIMEOUT, NO_RESPONSE, REQUEST_TIMEOUT, RETRIES, RETRY_BACKOFF, RETRY_STATUSES, \
+                                   TIMEOUT_FACTOR, TIMEOUT_SAMPLES, VERIFY_CERT, WAYBACK_MACHINE, WBM_API, \
+                                   WBM_MAX_REQUESTS, WBM_RATE
+
+# Errors where a server may have answered GET, although it didn't answer HEAD.
+HEAD_ERRORS = (aiohttp.ServerDisconnectedError, aiohttp.ClientResponseError, aiohttp.ClientPayloadError)
+
+
+class LinkError(Exception):
+    """ Raised for a link that got no response, holding the reason. """
+
+
+class HostStopped(LinkError):
+    """ Raised for a link that wasn't requested, as its host has stopped responding. """
+
+
+class Scheduler():
+    """ Sets timeouts from the latency seen so far and keeps track of hosts that have stopped responding. """
+
+    def __init__(self, telemetry: LinkTelemetry) -> None:
+        # Latencies are read from the telemetry of the requests.
+        self.telemetry = telemetry
+
+        # Current timeouts (s) of connecting and of reading, and the number of responses they were set from.
+        self.connect_timeout = REQUEST_TIMEOUT
+        self.read_timeout = REQUEST_TIMEOUT
+        self.samples = 0
+
+        # Failures in a row of each host (name and port), and requests that can be sent to each host at once.
+        self.failures = Counter()
+        self.slots = defaultdict(lambda: asyncio.Semaphore(MAX_PER_HOST))
+
+    def timeout(self, retry=False) -> aiohttp.ClientTimeout:
+        """ Returns timeout of a request. Retries always get the full timeout. """
+
+        if retry:
+            return aiohttp.ClientTimeout(total=None, sock_connect=REQUEST_TIMEOUT, sock_read=REQUEST_TIMEOUT)
+
+        phases = self.telemetry.phases
+        connect = phases.get('connect', []) + phases.get('connect_tls', [])
+        first_byte = phases.get('first_byte', [])
+
+        # Timeouts are updated after every TIMEOUT_SAMPLES responses.
+        if len(first_byte) >= self.samples + TIMEOUT_SAMPLES:
+            self.samples = len(first_byte)
+            self.read_timeout = adapt_timeout(first_byte)
+
+            if len(connect) >= TIMEOUT_SAMPLES:
+                self.connect_timeout = adapt_timeout(connect)
+
+        return aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+
+    def stopped(self, host: tuple) -> bool:
+        """ Returns True if a host (name and port) has failed too many times in a row to be requested. """
+        return self.failures[host] >= BREAKER_FAILURES
+
+    def record(self, host: tuple, failed: bool) -> None:
+        """ Records whether a request to a host failed. A response resets the host's failures. """
+
+        if not failed:
+            self.failures[host] = 0
+            return
+
+        self.failures[host] += 1
+
+        if self.failures[host] == BREAKER_FAILURES:
+            self.telemetry.hosts_stopped += 1
+
+
+class RateLimiter():
+    """ Spaces out requests so that no more than a given number start each second. """
+
+    def __init__(self, rate: float) -> None:
+        self.interval = 1 / rate
+        self.next_start = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        """ Waits until the next request can start. """
+
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            delay = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.interval
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class HostResolver(AbstractResolver):
+    """ Resolves host names for requests from addresses looked up beforehand. Hosts that weren't looked up beforehand
+        (eg. found in redirects) are looked up when needed. Every answer is kept, so each host is only looked up once. """
+
+    def __init__(self, telemetry: LinkTelemetry) -> None:
+        self.telemetry = telemetry
+
+        # Lookups are blocking calls, so they run in threads.
+        self.executor = ThreadPoolExecutor(max_workers=DNS_MAX_LOOKUPS)
+
+        # Lookup of each host, giving its addresses or None if the host could not be resolved.
+        self.lookups = {}
+
+        # Threads free to start a lookup. A thread is only freed when its lookup finishes, even if it timed out.
+        self.free_threads = None
+
+    def lookup(self, host: str) -> asyncio.Future:
+        """ Returns lookup of a host, starting it if the host hasn't been looked up. """
+
+        if host not in self.lookups:
+            self.lookups[host] = asyncio.ensure_future(self.getaddrinfo(host))
+
+        return self.lookups[host]
+
+    async def getaddrinfo(self, host: str):
+        """ Returns addresses of a host, or None if it can't be resolved in time. """
+
+        if self.free_threads is None:
+            self.free_threads = asyncio.Semaphore(DNS_MAX_LOOKUPS)
+
+        # The timeout starts once a thread is free, so time spent queued behind other lookups doesn't count.
+        await self.free_threads.acquire()
+
+        start = time.perf_counter()
+        lookup = asyncio.get_running_loop().run_in_executor(self.executor, addresses, host)
+        lookup.add_done_callback(lambda _: self.free_threads.release())
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(lookup), DNS_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.telemetry.record_lookup(time.perf_counter() - start)
+
+    async def resolve_all(self, hosts) -> set:
+        """ Looks up every host at the same time. Returns hosts that could not be resolved. """
+
+        hosts = list(hosts)
+        answers = await asyncio.gather(*[self.lookup(host) for host in hosts])
+
+        return {host for (host, addresses) in zip(hosts, answers) if not addresses}
+
+    async def resolve(self, host: str, port: int = 0, family=socket.AF_INET) -> list:
+        """ Returns addresses of a host in the form used by aiohttp. """
+
+        addresses = [address for address in await self.lookup(host) or [] if family == socket.AF_UNSPEC or address[0] == family]
+
+        if not addresses:
+            raise OSError('Could not resolve host ' + host)
+
+        return [{'hostname': host, 'host': address[4][0], 'port': port, 'family': address[0], 'proto': address[2],
+                 'flags': socket.AI_NUMERICHOST | socket.AI_NUMERICSERV} for address in addresses]
+
+    async def close(self) -> None:
+        self.executor.shutdown(wait=False)
+
+
+def request_all(links: list, telemetry=None, done=None, scheduler=None) -> dict:
+    """ Requests every link. Returns the status code of each link by position, EMPTY for blank links, or a LinkError
+        if the link got no response. Requests are measured by the given telemetry, if any. If done is given, it is
+        called with the position and result of each link as soon as its result is final. A scheduler can be given to
+        carry on with the timeouts and stopped hosts of earlier calls (eg. for each chunk of a file), it must share
+        their telemetry. """
+
+    telemetry = telemetry or LinkTelemetry()
+    scheduler = scheduler or Scheduler(telemetry)
+
+    return asyncio.run(request_links(links, telemetry, scheduler, done or (lambda index, result: None)))
+
+
+async def request_links(links: list, telemetry: LinkTelemetry, scheduler: Scheduler, done) -> dict:
+    """ Resolves the host of every link, then requests every link to a host that resolved using one pool of connections. """
+
+    telemetry.requested += len(links)
+
+    resolver = HostResolver(telemetry)
+    unresolved = await resolver.resolve_all({host_name(url) for url in links} - {None})
+
+    # Like requests, timeouts apply to connecting and to each read, not to the whole request. Time spent waiting
+    # for a pooled connection doesn't count, as most links are queued behind others.
+    connector = aiohttp.TCPConnector(limit=MAX_REQUESTS, limit_per_host=MAX_PER_HOST, ssl=VERIFY_CERT, resolver=resolver, use_dns_cache=False)
+
+    # Slots belong to the event loop of one call, so each call starts with new ones.
+    scheduler.slots.clear()
+
+    progress = asyncio.ensure_future(telemetry.show_progress())
+
+    try:
+        async with aiohttp.ClientSession(connector=connector, trace_configs=[telemetry.trace_config()]) as session:
+            results = await asyncio.gather(*[check_link(session, scheduler, index, url, unresolved, telemetry, done) for (index, url) in enumerate(links)],
+                                           return_exceptions=True)
+            await retry_links(session, scheduler, links, results, telemetry, done)
+    finally:
+        progress.cancel()
+
+    (telemetry.connect_timeout, telemetry.read_timeout) = (scheduler.connect_timeout, scheduler.read_timeout)
+
+    # Links still failing after every retry are final now.
+    for index, result in enumerate(results):
+        if transient(result):
+            done(index, final_result(result))
+
+    return {index: final_result(result) for index, result in enumerate(results)}
+
+
+async def retry_links(session: aiohttp.ClientSession, scheduler: Scheduler, links: list, results: list, telemetry: LinkTelemetry, done) -> None:
+    """ Retries links with transient failures, updating their results. Links are retried after every other link has
+        been checked, waiting longer before each retry. Hosts that have stopped responding are tried with one link
+        first, their other links are only retried if it gets a response. """
+
+    for attempt in range(RETRIES):
+        retry = [index for index, result in enumerate(results) if transient(result)]
+
+        if not retry:
+            return
+
+        await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+
+        probes = {}
+        for index in retry:
+            if scheduler.stopped(host_key(links[index])):
+                probes.setdefault(host_key(links[index]), index)
+
+        for (indices, probe) in [(list(probes.values()), True), ([index for index in retry if index not in probes.values()], False)]:
+            retried = await asyncio.gather(*[request_link(session, scheduler, links[index], retry=True, probe=probe) for index in indices],
+                                           return_exceptions=True)
+
+            for index, result in zip(indices, retried):
+                telemetry.record_retry(failure_kind(results[index]), failure_kind(result), recovered=not transient(result))
+                results[index] = result
+
+                if not transient(result):
+                    done(index, final_result(result))
+
+
+async def check_link(session: aiohttp.ClientSession, scheduler: Scheduler, index: int, url: str, unresolved: set, telemetry: LinkTelemetry, done):
+    """ Returns status code of a link (or the exception it failed with), recording whether it got a response. Results
+        that won't be retried are final. """
+
+    try:
+        result = await request_link(session, scheduler, url, unresolved=unresolved)
+    except Exception as e:
+        result = e
+
+    telemetry.record_link(failure_kind(result))
+
+    if not transient(result):
+        done(index, final_result(result))
+
+    # Exceptions are returned rather than raised, as gathered results.
+    return result
+
+
+async def request_link(session: aiohttp.ClientSession, scheduler: Scheduler, url: str, unresolved=(), retry=False, probe=False):
+    """ Returns status code of a link, after following redirects. Retries get the full timeout. Links to hosts that
+        have stopped responding aren't requested, unless probing whether the host has come back. """
+
+    if url == '':
+        return EMPTY
+
+    host = host_name(url)
+
+    if host in unresolved:
+        raise LinkError('Could not resolve host ' + host)
+
+    # Each port of a host is a different server, so is stopped separately.
+    key = host_key(url)
+
+    # Requests wait here, rather than for a connection, so that they can be stopped if their host stops responding.
+    async with scheduler.slots[key]:
+        if scheduler.stopped(key) and not probe:
+            raise HostStopped('Stopped requesting ' + host + ':' + str(key[1]) + ' after ' + str(BREAKER_FAILURES) + ' failures in a row')
+
+        try:
+            status = await send_request(session, url, scheduler.timeout(retry))
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError):
+            scheduler.record(key, failed=True)
+            raise
+
+        scheduler.record(key, failed=False)
+
+    return status
+
+
+async def send_request(session: aiohttp.ClientSession, url: str, timeout: aiohttp.ClientTimeout) -> int:
+    """ Returns status code of a link, trying HEAD before GET. """
+
+    try:
+        async with session.head(url, allow_redirects=True, timeout=timeout) as response:
+            # Some servers refuse or mishandle HEAD, so only successful answers are trusted.
+            if response.status < 400:
+                return response.status
+    except HEAD_ERRORS:
+        pass
+
+    async with session.get(url, allow_redirects=True, timeout=timeout) as response:
+        status = response.status
+
+        # Closing the response drops its connection without reading the body.
+        response.close()
+
+    return status
+
+
+def lookup_all(links: list, api=WBM_API, rate=WBM_RATE) -> dict:
+    """ Looks up every link on the wayback machine. Returns WAYBACK_MACHINE for each link with an archived snapshot,
+        NO_RESPONSE for each link without, or a LinkError if the lookup failed, by position. The API can be changed,
+        eg. to a local stand-in for testing. """
+    return asyncio.run(lookup_links(links, api, rate))
+
+
+async def lookup_links(links: list, api: str, rate: float) -> dict:
+    """ Looks up every link using one pool of connections, starting no more than rate lookups each second. """
+
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=REQUEST_TIMEOUT, sock_read=REQUEST_TIMEOUT)
+    connector = aiohttp.TCPConnector(limit=WBM_MAX_REQUESTS)
+    limiter = RateLimiter(rate)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        results = await asyncio.gather(*[lookup_link(session, limiter, api, url) for url in links], return_exceptions=True)
+
+    return {index: result if isinstance(result, str) else LinkError(describe(result)) for index, result in enumerate(results)}
+
+
+async def lookup_link(session: aiohttp.ClientSession, limiter: RateLimiter, api: str, url: str) -> str:
+    """ Returns WAYBACK_MACHINE if a link has an archived snapshot that was available when archived. """
+
+    await limiter.wait()
+
+    async with session.get(api + quote(url, safe='')) as response:
+        # Errors (eg. too many requests) fail the lookup rather than saying there is no snapshot.
+        response.raise_for_status()
+        response_json = await response.json(content_type=None)
+
+    # Fields of the closest snapshot, empty if there are no snapshots of the link.
+    closest_snapshot = response_json.get('archived_snapshots', {}).get('closest', {})
+
+    return WAYBACK_MACHINE if closest_snapshot.get('status') == '200' else NO_RESPONSE
+
+
+def addresses(host: str):
+    """ Returns addresses of a host, or None if it could not be resolved. """
+
+    try:
+        return socket.getaddrinfo(host, None, 0, socket.SOCK_STREAM)
+    except (OSError, UnicodeError):
+        return None
+
+
+def host_name(url: str):
+    """ Returns host name of a link, as it is looked up, or None if the link has no host name. """
+
+    try:
+        return yarl.URL(url).raw_host
+    except ValueError:
+        return None
+
+
+def host_key(url: str) -> tuple:
+    """ Returns host name and port of a link (the default port of its scheme if it has none), which requests are
+        limited and stopped by, or None if the link has no host name. """
+
+    try:
+        url = yarl.URL(url)
+    except ValueError:
+        return None
+
+    return (url.raw_host, url.port) if url.raw_host else None
+
+
+def adapt_timeout(latencies: list) -> float:
+    """ Returns timeout allowing for latencies well beyond the slowest seen so far, within MIN_TIMEOUT and REQUEST_TIMEOUT. """
+    return float(numpy.clip(TIMEOUT_FACTOR * numpy.percentile(latencies, 99), MIN_TIMEOUT, REQUEST_TIMEOUT))
+
+
+def transient(result) -> bool:
+    """ Returns True if a result is a failure that may not last, eg. a timeout or a server saying it is busy. """
+
+    if isinstance(result, int):
+        return result in RETRY_STATUSES
+
+    return isinstance(result, (HostStopped, asyncio.TimeoutError, aiohttp.ServerDisconnectedError, aiohttp.ClientOSError))
+
+
+def failure_kind(exception) -> str:
+    """ Returns kind of failure, as reported by telemetry, or None if there was a response. """
+
+    if isinstance(exception, (int, str)):
+        return None
+    if isinstance(exception, HostStopped):
+        return 'host_stopped'
+    if isinstance(exception, LinkError):
+        return 'dns'
+    if isinstance(exception, asyncio.TimeoutError):
+        return 'timeout'
+    if isinstance(exception, aiohttp.ClientConnectorError):
+        return 'connection'
+    if isinstance(exception, aiohttp.InvalidURL):
+        return 'invalid_url'
+
+    return 'other'
+
+
+def final_result(result):
+    """ Returns a status code or link check code as it is, or a LinkError describing an exception. """
+    return result if isinstance(result, (int, str)) else LinkError(describe(result))
+
+
+def describe(exception: BaseException) -> str:
+    """ Returns reason a link got no response. """
+
+    if isinstance(exception, LinkError):
+        return str(exception)
+
+    if isinstance(exception, asyncio.TimeoutError):
+        return 'Timed out'
+
+    return type(exception).__name__ + (': ' + str(exception) if str(exception) else '')
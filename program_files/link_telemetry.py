@@ -0,0 +1,190 @@
+"""
+Link Telemetry:
+
+Measures link checking, so that concurrency and timeouts can be tuned from data. Progress (links checked, links per
+second and failures) is printed while links are checked. At the end, a report is saved next to the results. It holds
+throughput, latency percentiles of each phase of a request, failures by kind, counts of each result and the slowest
+hosts.
+
+Phases are measured with aiohttp's request tracing, apart from host name lookups, which are timed by the link engine.
+aiohttp doesn't time TLS handshakes separately, so connections to https links are measured as one phase (connect_tls).
+"""
+
+import json
+import time
+import numpy
+import asyncio
+import aiohttp
+
+from collections import Counter, defaultdict
+from program_files.helpers import info
+from program_files.settings import PROGRESS_INTERVAL, SLOWEST_HOSTS
+
+# Percentiles reported for every phase.
+PERCENTILES = [50, 90, 99]
+
+
+class LinkTelemetry():
+    def __init__(self) -> None:
+        """ Initialises empty measurements. """
+
+        self.start = time.perf_counter()
+
+        # Number of unique links, and of those, links whose results were read from the cache. Values that weren't
+        # valid links are counted separately, as they are never requested.
+        self.links = 0
+        self.cached = 0
+        self.invalid = 0
+
+        # Links requested and checked so far.
+        self.requested = 0
+        self.checked = 0
+
+        # Seconds taken by every request in each phase, by phase.
+        self.phases = defaultdict(list)
+
+        # Seconds taken by every request to each host, by host.
+        self.hosts = defaultdict(list)
+
+        self.failures = Counter()
+        self.results = Counter()
+        self.requests = 0
+
+        # Links retried and links that got a response when retried, hosts that stopped being requested and the
+        # timeouts (s) in use at the end.
+        self.retried = 0
+        self.recovered = 0
+        self.hosts_stopped = 0
+        self.connect_timeout = None
+        self.read_timeout = None
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """ Returns trace config that records the phases of every request sent by a session. """
+
+        trace_config = aiohttp.TraceConfig()
+
+        trace_config.on_request_start.append(self.on_request_start)
+        trace_config.on_connection_queued_start.append(self.on_phase_start)
+        trace_config.on_connection_queued_end.append(self.on_connection_queued_end)
+        trace_config.on_connection_create_start.append(self.on_phase_start)
+        trace_config.on_connection_create_end.append(self.on_connection_create_end)
+        trace_config.on_request_headers_sent.append(self.on_phase_start)
+        trace_config.on_request_redirect.append(self.on_phase_end('first_byte'))
+        trace_config.on_request_end.append(self.on_request_end)
+        trace_config.on_request_exception.append(self.on_request_end)
+
+        return trace_config
+
+    async def on_request_start(self, session, context, params) -> None:
+        context.host = params.url.raw_host
+        context.https = params.url.scheme == 'https'
+        context.request_start = context.phase_start = time.perf_counter()
+        self.requests += 1
+
+    async def on_phase_start(self, session, context, params) -> None:
+        context.phase_start = time.perf_counter()
+
+    def on_phase_end(self, phase: str):
+        """ Returns callback recording a phase of a request, from the start of the phase. """
+
+        async def on_phase_end(session, context, params) -> None:
+            self.phases[phase].append(time.perf_counter() - context.phase_start)
+
+        return on_phase_end
+
+    async def on_connection_queued_end(self, session, context, params) -> None:
+        queued = time.perf_counter() - context.phase_start
+        self.phases['queued'].append(queued)
+
+        # Time spent waiting for a connection says nothing about the host, so isn't counted against it.
+        context.request_start += queued
+
+    async def on_connection_create_end(self, session, context, params) -> None:
+        self.phases['connect_tls' if context.https else 'connect'].append(time.perf_counter() - context.phase_start)
+
+    async def on_request_end(self, session, context, params) -> None:
+        now = time.perf_counter()
+
+        # Exceptions can happen before headers are sent, in which case there is no first byte.
+        if not isinstance(params, aiohttp.TraceRequestExceptionParams):
+            self.phases['first_byte'].append(now - context.phase_start)
+
+        self.hosts[context.host].append(now - context.request_start)
+
+    def record_lookup(self, seconds: float) -> None:
+        """ Records time taken to look up a host name. """
+        self.phases['dns'].append(seconds)
+
+    def record_link(self, failure=None) -> None:
+        """ Records a link that has been checked, and the kind of failure if it got no response. """
+
+        self.checked += 1
+
+        if failure is not None:
+            self.failures[failure] += 1
+
+    def record_retry(self, failure, retry_failure, recovered: bool) -> None:
+        """ Records a retried link, with the kind of failure before and after it was retried (or None if it got a
+            response, eg. a busy server), and whether it recovered, ie. its new result won't be retried again. """
+
+        self.retried += 1
+
+        if failure is not None:
+            self.failures[failure] -= 1
+
+        if retry_failure is not None:
+            self.failures[retry_failure] += 1
+
+        if recovered:
+            self.recovered += 1
+
+    def record_results(self, results: dict) -> None:
+        """ Records the final result of every unique link (eg. after looking up links on the wayback machine). """
+        self.results.update(str(result) for result in results.values())
+
+    async def show_progress(self) -> None:
+        """ Prints progress every PROGRESS_INTERVAL seconds, until cancelled. """
+
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            info('Checked ' + str(self.checked) + ' of ' + str(self.requested) + ' link(s), ' + '%.1f' % self.rate() +
+                 ' per second. ' + str(self.failures['timeout']) + ' timed out, ' + str(sum(self.failures.values())) + ' failed in total.')
+
+    def rate(self) -> float:
+        """ Returns links checked per second. """
+        return self.checked / max(time.perf_counter() - self.start, 1e-9)
+
+    def report(self) -> dict:
+        """ Returns all measurements, summarised. """
+
+        slowest = sorted(self.hosts.items(), key=lambda host: -numpy.mean(host[1]))[:SLOWEST_HOSTS]
+
+        return {'seconds': round(time.perf_counter() - self.start, 3),
+                'links': {'unique': self.links, 'cached': self.cached, 'requested': self.requested, 'checked': self.checked, 'invalid': self.invalid},
+                'links_per_second': round(self.rate(), 2),
+                'requests': self.requests,
+                'latency': {phase: summarise(seconds) for phase, seconds in sorted(self.phases.items())},
+                'failures': {kind: count for kind, count in self.failures.items() if count > 0},
+                'retries': {'retried': self.retried, 'recovered': self.recovered},
+                'hosts_stopped': self.hosts_stopped,
+                'timeouts': {'connect': self.connect_timeout, 'read': self.read_timeout},
+                'results': dict(sorted(self.results.items())),
+                'slowest_hosts': [dict(host=host, **summarise(seconds)) for host, seconds in slowest]}
+
+    def save(self, report_path: str) -> None:
+        """ Writes report to a JSON file. """
+
+        with open(report_path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=2)
+
+        info('Link check report saved to ' + report_path)
+
+
+def summarise(seconds: list) -> dict:
+    """ Returns count, mean, percentiles and maximum of a list of times, in seconds. """
+
+    summary = {'count': len(seconds), 'mean': round(float(numpy.mean(seconds)), 4)}
+    summary.update({'p' + str(percentile): round(float(value), 4) for percentile, value in zip(PERCENTILES, numpy.percentile(seconds, PERCENTILES))})
+    summary['max'] = round(float(numpy.max(seconds)), 4)
+
+    return summary
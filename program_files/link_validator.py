@@ -0,0 +1,70 @@
+"""
+Link Validator:
+
+Formats and validates links before they are checked, without any network requests. Every value of a url column is
+put into one canonical form (eg. 'HTTPS://Example.ac.uk/' and 'www.example.ac.uk' are both 'http://www.example.ac.uk'),
+so that the same site is only checked once. Values that can't be links (eg. email addresses, free text, or hosts
+without a valid top level domain) are marked INVALID instead of being requested.
+
+Each distinct value is only formatted once, with every step applied to all of them at the same time.
+"""
+
+import pandas as pd
+
+from pandas import Series
+from program_files.settings import INVALID
+
+# Scheme at the start of a link, allowing for the typos ';' and '\'.
+SCHEME = r'^https?\s*[:;]\s*[/\\]{1,3}'
+
+# Parts of a link (after the scheme). Hosts end at a port, path, query or fragment, and links can't contain whitespace.
+PARTS = r'^(?P<host>[^/\\?#:\s]+)(?::(?P<port>\d{1,5}))?(?P<path>[/\\?#]\S*)?$'
+
+# Characters of internationalised domain names.
+UNICODE = '\u0080-\uffff'
+
+# Host names are dot separated labels of letters, digits and hyphens (not at either end), with a top level domain of
+# letters (or an internationalised top level domain). IPv4 addresses are allowed too.
+LABEL = '[a-z0-9' + UNICODE + '](?:[a-z0-9' + UNICODE + '-]{0,61}[a-z0-9' + UNICODE + '])?'
+DOMAIN = '(?:' + LABEL + r'\.)+(?:[a-z' + UNICODE + ']{2,63}|xn--[a-z0-9-]{1,59})'
+OCTET = r'(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)'
+IPV4 = r'(?:' + OCTET + r'\.){3}' + OCTET
+
+
+def format_links(links: Series) -> Series:
+    """ Returns the canonical form of every link, an empty string for blank values, or INVALID for values that
+        aren't links. """
+
+    # Repeated values are only formatted once.
+    (codes, values) = pd.factorize(links.fillna(''))
+    formatted = format_values(Series(values, dtype=links.dtype))
+
+    return Series(formatted.to_numpy(dtype=object)[codes], index=links.index, dtype=links.dtype)
+
+
+def format_values(values: Series) -> Series:
+    """ Formats distinct values. Links are given the http scheme and www. (unless the host is an IP address), hosts
+        are lower cased and default ports, fragments and empty paths are removed. Paths and queries keep their case. """
+
+    values = values.str.strip().str.replace(SCHEME, '', regex=True, case=False)
+    parts = values.str.extract(PARTS)
+
+    host = parts['host'].str.lower().str.rstrip('.')
+    port = parts['port'].fillna('')
+    path = parts['path'].fillna('').str.replace('\\', '/', regex=False).str.replace(r'#.*$', '', regex=True)
+
+    ip_address = host.str.fullmatch(IPV4).fillna(False).astype(bool)
+    domain = host.str.fullmatch(DOMAIN).fillna(False).astype(bool)
+    port_number = pd.to_numeric(port, errors='coerce')
+    valid = (ip_address | domain) & ((port == '') | ((port_number > 0) & (port_number <= 65535)))
+
+    # Default ports, and paths of only a slash, don't change the page a link goes to.
+    port = port.mask(port.isin(['80', '443']), '')
+    port = (':' + port).where(port != '', '')
+    path = path.mask(path == '/', '')
+
+    host = host.where(ip_address | host.str.startswith('www.').fillna(False).astype(bool), 'www.' + host)
+
+    formatted = ('http://' + host + port + path).where(valid, INVALID)
+
+    return formatted.where(values != '', '')
@@ -4,14 +4,12 @@ Record Matcher:
 Contains functions that match records across two delimited files.
 """
 
-import os
-import pandas as pd
-
 from pandas.core.frame import DataFrame
 from program_files.csv_dedupe import csv_link
 from program_files.menu import SingleSelectionMenu
-from program_files.settings import DATA_PATH, TEMP_PATH, SCL_COLUMNS, UCAS_COLUMNS
-from program_files.helpers import get_delimiter, get_encoding, open_config, open_config, get_file_path, pre_clean, info, todo, error, warning
+from program_files.settings import DATA_PATH, OUTPUT_PATH, SCL_COLUMNS, UCAS_COLUMNS
+from program_files.helpers import open_config, get_file_path, info, todo, error, warning
+from program_files.data_loader import load_pair
 
 
 def match_records() -> None:
@@ -24,6 +22,35 @@ def match_records() -> None:
     # Show that configuration files have been loaded successfully.
     info('Configuration files loaded successfully.', pre='\n')
 
+    # Get filepath for each file
+    conf_a.path = get_file_path(DATA_PATH + conf_a.folder_name, 'Please put ' + conf_a.folder_name + ' data in ' + conf_a.folder_name + ' folder. This folder must contain a single data file.')
+    conf_b.path = get_file_path(DATA_PATH + conf_b.folder_name, 'Please put ' + conf_b.folder_name + ' data in ' + conf_b.folder_name + ' folder. This folder must contain a single data file.')
+
+    # Prompt user to determine whether or not ucas and scl data is being used (or not)
+    todo('Please select an option from the list below.', pre='\n', post='\n')
+
+    matcher_menu = SingleSelectionMenu(options=["Find schools with internal ID that now have UCAS ID (Works with: SCL and UCAS data only)", 
+                                                "Find matches between files (Works with: All data)"])
+
+    selection = matcher_menu.show()
+
+    # Prompt user to choose between linking every record and only those that have changed since the last run
+    todo('Please select an option from the list below.', pre='\n', post='\n')
+
+    link_menu = SingleSelectionMenu(options=["Link all records", 
+                                             "Link only new or modified records (the first file is kept indexed between runs)"])
+
+    incremental = link_menu.show() == 2
+
+    # Find matches, formatting scl and ucas data if selected
+    link_records(conf_a, conf_b, format=selection == 1, incremental=incremental)
+
+
+def link_records(conf_a, conf_b, format=False, output_path=OUTPUT_PATH, settings_file=None, incremental=False) -> None:
+    """ Matches records across the files of two configurations. Used by the menu and by batch jobs.
+        A settings file of a trained model can be given to use instead of the model store. If incremental, 
+        only records in the second file that are new or modified since the last run are linked. """
+
     # Check that two different configurations were selected 
     if conf_a.config_path == conf_b.config_path:
         error('You selected the same configuration twice (' + conf_a.config_path + '). Select two different config files.')
@@ -38,61 +65,30 @@ def match_records() -> None:
               '\tThis can be solved by adding/removing \'columns_names\' in the respective configuration files\n' + 
               '\tsuch that both have the same number listed. ')
 
-    # Get filepath for each file
-    conf_a.path = get_file_path(DATA_PATH + conf_a.folder_name, 'Please put ' + conf_a.folder_name + ' data in ' + conf_a.folder_name + ' folder. This folder must contain a single data file.')
-    conf_b.path = get_file_path(DATA_PATH + conf_b.folder_name, 'Please put ' + conf_b.folder_name + ' data in ' + conf_b.folder_name + ' folder. This folder must contain a single data file.')
+    # Import both files at the same time. Only columns being compared (and those used to identify scl and ucas data) are
+    # imported. Whole records are read from the files when results are written.
+    identifying_columns = SCL_COLUMNS + UCAS_COLUMNS if format else []
+    ((data_a, rows_a), (data_b, rows_b)) = load_pair(conf_a, conf_a.column_names, conf_b, conf_b.column_names, optional=identifying_columns, rows=True)
 
-    # Detect encoding for each file and update configurations 
-    conf_a.encoding = get_encoding(conf_a.path)
-    conf_b.encoding = get_encoding(conf_b.path)
-
-    # Pre-clean files as per configuration 
-    if conf_a.pre_clean:
-        pre_clean(conf_a.path, conf_a.encoding, conf_a.characters_to_clean)
-    
-    if conf_b.pre_clean:
-        pre_clean(conf_b.path, conf_b.encoding, conf_b.characters_to_clean)
-
-    # Blank line for menu formatting 
-    print()
-
-    # Auto-detect delimiters being used in files
-    file_a_delimiter = get_delimiter(conf_a.path, encoding=conf_a.encoding)
-    file_b_delimiter = get_delimiter(conf_b.path, encoding=conf_b.encoding)
-
-    # Stores file contents present in configured folders into data frames
-    data_a: DataFrame = pd.read_csv(conf_a.path, 
-                                    sep=file_a_delimiter,
-                                    dtype=str,                  # All column types set to string to prevent type errors. 
-                                    usecols=conf_a.columns,     # Only import number of columns specified in config.
-                                    keep_default_na=False,      # Prevents pandas from filling empty cells with NaN.
-                                    encoding=conf_a.encoding)   # Prevents decoding error when importing the data. 
-    
-    data_b: DataFrame = pd.read_csv(conf_b.path, 
-                                    sep=file_b_delimiter,
-                                    dtype=str,
-                                    usecols=conf_b.columns,
-                                    keep_default_na=False,
-                                    encoding=conf_b.encoding) 
+    # Rows are read from the files until results have been written, then they are closed.
+    with rows_a, rows_b:
+        # Blank line for menu formatting 
+        print()
 
-    # Prompt user to determine whether or not ucas and scl data is being used (or not)
-    todo('Please select an option from the list below.', post='\n')
+        # Remove unnecessary records, identifying scl and ucas data if required
+        rows = {conf_a.config_path: rows_a, conf_b.config_path: rows_b}
+        (data_a, conf_a, data_b, conf_b) = generate_clean_files(data_a, conf_a, data_b, conf_b, format=format)
 
-    matcher_menu = SingleSelectionMenu(options=["Find schools with internal ID that now have UCAS ID (Works with: SCL and UCAS data only)", 
-                                                "Find matches between files (Works with: All data)"])
-
-    selection = matcher_menu.show()
-
-    # Continue based on user selection 
-    if selection == 1: 
-        (conf_a, conf_b) = generate_clean_files(data_a, conf_a, data_b, conf_b, format=True)
-    elif selection == 2: 
-        (conf_a, conf_b) = generate_clean_files(data_a, conf_a, data_b, conf_b, format=False)
+        # Keep rows of the records that are left, in the same order. Index is then reset so that the position of each 
+        # record matches its index.
+        rows_a = rows[conf_a.config_path].select(data_a.index)
+        rows_b = rows[conf_b.config_path].select(data_b.index)
 
-    # Find Matches
-    ## Creates instance of and runs the linker program with the given configuration
-    linker = csv_link.CsvLink(conf_a, conf_b)
-    linker.run()
+        # Find Matches
+        ## Creates instance of and runs the linker program with the given configuration and data
+        linker = csv_link.CsvLink(conf_a, data_a.reset_index(drop=True), rows_a, conf_b, data_b.reset_index(drop=True), rows_b,
+                                  output_path=output_path, settings_file=settings_file, incremental=incremental)
+        linker.run()
 
 
 def identify_data(data_a, conf_a, data_b, conf_b):
@@ -120,12 +116,8 @@ def identify_data(data_a, conf_a, data_b, conf_b):
     return None
 
 
-def generate_clean_files(data_a, conf_a, data_b, conf_b, format=False) -> None:
-    """ Takes data frame produced by pandas, extracts unnecessary records and exports clean csv files to be used by duplicate finder."""
-
-    # Generate directory for pandas generated csv files
-    if not os.path.exists(DATA_PATH + TEMP_PATH):
-        os.mkdir(DATA_PATH + TEMP_PATH)
+def generate_clean_files(data_a, conf_a, data_b, conf_b, format=False) -> tuple:
+    """ Takes data frames produced by pandas and extracts unnecessary records. Returns data frames (and matching configurations) to be used by duplicate finder."""
 
     # If the user has opted to find scohols with internal ID that now has UCAS ID
     if format:
@@ -145,20 +137,11 @@ def generate_clean_files(data_a, conf_a, data_b, conf_b, format=False) -> None:
             # Useful Regular Expression Site: https://regex101.com/ 
             scl = scl[scl['School code'].str.contains(r'^[a-zA-Z]{2}\d{3,5}$', na=False)]
 
-            # Generate clean files and place in directory
-            # Index is set to false to prevent pandas from writing the ID's it has given to each row.
-            scl.to_csv(DATA_PATH + TEMP_PATH + 'temp_a.csv', index=False)
-            ucas.to_csv(DATA_PATH + TEMP_PATH + 'temp_b.csv', index=False)  
-
-            return (scl_conf, ucas_conf)
+            # Index is kept, so that the rows of the records that are left can be found.
+            return (scl, scl_conf, ucas, ucas_conf)
         else:
             warning('Unable to detect ucas and scl data. Continuing as if generic files were used.', pre='\n') 
             warning('If you are certain you selected ucas and scl data, ensure that the subset of\n' +
                     '          columns are up to date in settings.py', post='\n')
 
-    # Generate clean files and place in directory
-    # Index is set to false to prevent pandas from writing the ID's it has given to each row.
-    data_a.to_csv(DATA_PATH + TEMP_PATH + 'temp_a.csv', index=False)
-    data_b.to_csv(DATA_PATH + TEMP_PATH + 'temp_b.csv', index=False)
-
-    return (conf_a, conf_b)
+    return (data_a, conf_a, data_b, conf_b)
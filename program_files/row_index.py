@@ -0,0 +1,223 @@
+"""
+Row Index:
+
+Fetches rows of a delimited file by row number, without keeping the file in memory. The file is memory-mapped and the
+byte offset of every row is found once, then cached (keyed by path, size and modification time) for later runs. Used
+to write whole records to results when only the columns being compared have been imported.
+"""
+
+import io
+import os
+import csv
+import mmap
+import numpy
+import codecs
+import hashlib
+import logging
+
+from pandas import DataFrame
+from program_files.helpers import warning
+from program_files.file_profiler import FileProfile, cache_key, file_stamp, file_name
+from program_files.settings import CACHE_PATH, DATA_PATH, ROW_INDEX_CHUNK_SIZE
+
+# Byte values of characters that decide where rows end. Rows are found using these bytes alone, which only works for
+# encodings that write them as single bytes that can't appear inside other characters.
+QUOTE = ord('"')
+NEWLINE = ord('\n')
+CARRIAGE_RETURN = ord('\r')
+SINGLE_BYTE_LINES = ['utf-8', 'cp1252', 'iso8859-15', 'ascii']
+
+
+class MappedRows():
+    """ Rows of a memory-mapped file, fetched by position. """
+
+    def __init__(self, file_map: mmap.mmap, encoding: str, delimiter: str, header: list, offsets, table=None) -> None:
+        self.map = file_map
+        self.header = header
+        self.encoding = encoding
+        self.delimiter = delimiter
+
+        # Start and end byte offsets of every row, by position.
+        self.offsets = offsets
+
+        # Translation table removing characters while rows are read, if pre-cleaning.
+        self.table = table
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def select(self, positions) -> 'MappedRows':
+        """ Returns rows at the given positions, in the given order. Row positions then refer to the selection. """
+
+        offsets = self.offsets[numpy.asarray(positions, dtype=numpy.int64)]
+        return MappedRows(self.map, self.encoding, self.delimiter, self.header, offsets, self.table)
+
+    def fetch(self, positions):
+        """ Yields a tuple of values for each row at the given positions. """
+
+        width = len(self.header)
+
+        for (start, end) in self.offsets[positions].tolist():
+            text = self.map[start:end].decode(self.encoding).rstrip('\r\n')
+
+            if self.table is not None:
+                text = text.translate(self.table)
+
+            # Rows with more values than there are columns are cut short, as they are when imported.
+            row = next(csv.reader(io.StringIO(text, newline=''), delimiter=self.delimiter), [])
+            yield tuple(row[:width]) + ('',) * (width - len(row))
+
+    def close(self) -> None:
+        """ Closes the memory map, which is shared with every selection of the rows. """
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class FrameRows():
+    """ Rows of an imported data frame, fetched by position. Used when a file can't be memory-mapped. """
+
+    def __init__(self, data: DataFrame) -> None:
+        self.data = data
+        self.header = list(data.columns)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def select(self, positions) -> 'FrameRows':
+        """ Returns rows at the given positions, in the given order. Row positions then refer to the selection. """
+        return FrameRows(self.data.take(numpy.asarray(positions, dtype=numpy.int64)))
+
+    def fetch(self, positions):
+        """ Yields a tuple of values for each row at the given positions. """
+        return self.data.take(positions).itertuples(index=False, name=None)
+
+    def close(self) -> None:
+        """ Does nothing, as there is no file to close. Lets rows of either kind be closed the same way. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+def map_rows(conf, profile: FileProfile, header: list, row_count: int):
+    """ Returns memory-mapped rows of a profiled file, or None if the file can't be memory-mapped (or the rows found
+        don't line up with the imported rows). """
+
+    encoding = codecs.lookup(profile.encoding).name
+
+    # Only files where quotes and line endings are single bytes can be split into rows without decoding them.
+    if encoding not in SINGLE_BYTE_LINES and not (encoding == 'utf-8-sig' and profile.bom):
+        return None
+
+    table = None
+
+    if conf.pre_clean:
+        removed = ''.join(conf.characters_to_clean)
+
+        # Removing characters that rows are split on would move where rows end.
+        if any(character in removed for character in ['"', '\n', '\r', profile.delimiter]):
+            return None
+
+        table = str.maketrans({character: None for character in removed})
+
+    offsets = load_offsets(profile.path, 3 if profile.bom else 0)
+
+    if len(offsets) != row_count:
+        warning('Could not index rows of ' + file_name(profile.path) + ' (found ' + str(len(offsets)) + ' rows, expected ' +
+                str(row_count) + '). The whole file will be kept in memory instead.', pre='\n')
+        return None
+
+    # A byte order mark is skipped by the offsets, so rows are decoded as plain UTF-8.
+    encoding = 'utf-8' if encoding == 'utf-8-sig' else encoding
+
+    with open(profile.path, 'rb') as file:
+        file_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    return MappedRows(file_map, encoding, profile.delimiter, header, offsets, table)
+
+
+def load_offsets(file_path: str, start: int):
+    """ Returns start and end offsets of every row (after the header), from the cache if the file hasn't changed. """
+
+    os.makedirs(DATA_PATH + CACHE_PATH, exist_ok=True)
+
+    # Index files are named after the file and its stamp, so a changed file is indexed again.
+    name = hashlib.sha1(cache_key(file_path).encode()).hexdigest()[:16]
+    stamp = hashlib.sha1(str(file_stamp(file_path)).encode()).hexdigest()[:8]
+    index_path = DATA_PATH + CACHE_PATH + name + '-' + stamp + '.rows.npy'
+
+    if os.path.exists(index_path):
+        return numpy.load(index_path, mmap_mode='r')
+
+    offsets = find_offsets(file_path, start)
+
+    temp_path = index_path + '.' + str(os.getpid()) + '.tmp'
+    with open(temp_path, 'wb') as index_file:
+        numpy.save(index_file, offsets)
+    os.replace(temp_path, index_path)
+
+    # Remove indices of earlier versions of the file
+    for cached in os.listdir(DATA_PATH + CACHE_PATH):
+        if cached.startswith(name + '-') and cached.endswith('.rows.npy') and DATA_PATH + CACHE_PATH + cached != index_path:
+            os.remove(DATA_PATH + CACHE_PATH + cached)
+
+    logging.info('indexed %d rows of %s' % (len(offsets), file_path))
+
+    return offsets
+
+
+def find_offsets(file_path: str, start: int):
+    """ Finds start and end offsets of every row after the header. A row ends at a line ending that isn't inside
+        quotes, ie. one with an even number of quotes before it. Blank rows are left out, as they are when imported. """
+
+    size = os.path.getsize(file_path)
+
+    if size <= start:
+        return numpy.empty((0, 2), dtype=numpy.int64)
+
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+        data = numpy.frombuffer(file_map, dtype=numpy.uint8)
+
+        ends = []
+        quotes_before = 0  # Number of quotes in earlier chunks
+
+        # Files are scanned a chunk at a time, so memory used doesn't grow with the size of the file.
+        for chunk_start in range(start, size, ROW_INDEX_CHUNK_SIZE):
+            chunk = data[chunk_start:chunk_start + ROW_INDEX_CHUNK_SIZE]
+
+            quotes = numpy.flatnonzero(chunk == QUOTE)
+            newlines = numpy.flatnonzero(chunk == NEWLINE)
+
+            # Line endings with an even number of quotes before them end a row.
+            outside = (numpy.searchsorted(quotes, newlines) + quotes_before) % 2 == 0
+            ends.append(newlines[outside] + chunk_start + 1)
+
+            quotes_before += len(quotes)
+
+        ends = numpy.concatenate(ends)
+
+        # The last row may not have a line ending.
+        if len(ends) == 0 or ends[-1] != size:
+            ends = numpy.append(ends, size)
+
+        starts = numpy.concatenate([[start], ends[:-1]])
+
+        # Blank rows only hold a line ending.
+        length = ends - starts
+        first = data[starts]
+        blank = ((length == 1) & (first == NEWLINE)) | ((length == 2) & (first == CARRIAGE_RETURN))
+
+        # The map can't be closed while arrays still point into it.
+        del data, chunk, first
+
+    offsets = numpy.stack([starts, ends], axis=1)[~blank].astype(numpy.int64)
+
+    # The first row is the header
+    return offsets[1:]
@@ -3,10 +3,29 @@
 # File Paths 
 DATA_PATH = './data/'
 CONFIG_PATH = './configurations/'
-TRAINING_PATH = 'training/'
+MODELS_PATH = 'models/'
 TEMP_PATH = 'tmp/'
+CACHE_PATH = 'cache/'
+SNAPSHOT_PATH = 'snapshots/'
 OUTPUT_PATH = './output/'
 
+# Pre-cleaning
+CLEAN_CHUNK_SIZE = 1024 * 1024  # Number of characters read from a file at a time while removing unwanted characters.
+
+# Row indexing
+ROW_INDEX_CHUNK_SIZE = 64 * 1024 * 1024  # Number of bytes of a file scanned at a time while finding where its rows are.
+
+# File profiling
+ENCODINGS = ['utf_8', 'Windows-1252', 'iso8859_15', 'ascii', 'utf_16', 'utf_32']  # Potential encodings, tried in order.
+PROFILE_SAMPLE_SIZE = 1024 * 1024   # Number of bytes sampled from the start of a file to detect its encoding and delimiter.
+PROFILE_CACHE = 'profiles.json'     # Cache of detected file profiles, kept in the cache folder between runs.
+
+# Record matching and duplicate detection
+NUM_CORES = None  # Number of cores used to score record pairs. None uses every available core (shared between batch jobs).
+THRESHOLD_SAMPLE = 20000                  # Records used to find the match threshold. Below 1, a fraction of records. None uses every record.
+THRESHOLD_REPORT = 'threshold_report.csv' # Estimated precision and recall at a range of thresholds, saved with the results.
+WRITE_CHUNK_SIZE = 10000                  # Number of rows written to results at a time.
+
 
 
 """ ---------- Menu Option One ---------- """
@@ -16,6 +35,12 @@ POTENTIAL_MATCHES = 'potential_matches.csv'
 A_ONLY = 'a_only.csv'
 B_ONLY = 'b_only.csv'
 
+# Reference indices. Files are kept in a folder for each model in the indices folder.
+INDEX_PATH = 'indices/'
+REFERENCE_INDEX = 'reference_index'  # Model with the first file's records indexed.
+LINK_STATE = 'links.json'            # Links found for records in the second file, so they aren't linked again.
+BLOCKING_INDEX = 'blocking_index'    # Model with the first file's records indexed (pickled), used when linking all records.
+
 # Column names (subset) for file identification
 UCAS_COLUMNS = ['School', 'Site code', 'Time stamp', 'School Name', 'Former name', 'Mailsort']
 SCL_COLUMNS = ['School code', 'Short name', 'Full name', 'Hercules update timestamp']
@@ -33,10 +58,32 @@ POTENTIAL_DUPLICATES = 'potential_duplicates.csv'
 
 # File names
 LINKS_CHECKED = 'links_checked.csv'
+LINK_REPORT = 'links_report.json'  # Throughput, latency and failures of the run, saved next to the results.
+LINK_CHECKPOINT = 'links_checkpoint.jsonl'  # Results found so far, so a run that stops can carry on. Removed when a run finishes.
+
+# Chunking
+LINK_CHUNK_ROWS = 10000  # Number of rows of a file imported, checked and written at a time.
 
 # Request Options
 REQUEST_TIMEOUT = 30  # Length of time (s) a site has to respond to request.
 VERIFY_CERT = False   # Determines whether or not a sites security certificate is verified. 
+MAX_REQUESTS = 1000   # Number of requests that can be in flight at once.
+MAX_PER_HOST = 8      # Number of connections that can be open to the same host at once.
+DNS_TIMEOUT = 5       # Length of time (s) a host name has to resolve, before links to it are marked NOR.
+DNS_MAX_LOOKUPS = 64  # Number of host names that can be looked up at once.
+
+# Timeouts and retries
+MIN_TIMEOUT = 5          # Shortest timeout (s) set from observed latency. Timeouts are never longer than REQUEST_TIMEOUT.
+TIMEOUT_FACTOR = 4       # Timeouts are set to this many times the 99th percentile of connect and response times seen so far.
+TIMEOUT_SAMPLES = 100    # Number of responses needed before timeouts are set from latency, and between updates.
+RETRIES = 2              # Number of times links with transient failures are retried, with the full REQUEST_TIMEOUT.
+RETRY_BACKOFF = 2        # Length of time (s) waited before retrying, doubled before each retry after the first.
+RETRY_STATUSES = [429, 502, 503, 504]  # Response codes of busy or unavailable servers, retried as transient failures.
+BREAKER_FAILURES = 3     # Number of failures in a row before the rest of a host's links are no longer requested.
+
+# Telemetry
+PROGRESS_INTERVAL = 10  # Length of time (s) between progress messages while links are checked.
+SLOWEST_HOSTS = 10      # Number of hosts listed in the report, slowest first.
 
 # Link check codes printed in 'Link check' column of output. 
 EMPTY = 'EMP'
@@ -44,6 +91,14 @@ NO_RESPONSE = 'NOR'
 WAYBACK_MACHINE = 'WBM'
 INVALID = 'INV'
 
+# Link check cache
+LINK_CACHE = 'link_results.json'  # Results of link checks, kept in the cache folder between runs.
+LINK_CACHE_DAYS = {'2xx': 14,     # Days a result is reused before the link is checked again, by class of result.
+                   '3xx': 14,     # Results of a class not listed (or listed as 0) are never reused.
+                   '4xx': 3,
+                   '5xx': 1,
+                   NO_RESPONSE: 1}
+
 # Wayback machine API
 USE_WBM = False # True:  For links that dont yeild a response (NOR), will write 'WBM' 
                 #        if there is a snapshot of the site available in the 
@@ -51,10 +106,32 @@ USE_WBM = False # True:  For links that dont yeild a response (NOR), will write
                 # False: Will print NOR for all links that dont yeild a response. Will 
                 #        not check Wayback Machine. 
 WBM_API = 'https://archive.org/wayback/available?url='
+WBM_MAX_REQUESTS = 4            # Number of lookups that can be in flight at once.
+WBM_RATE = 5                    # Number of lookups that can start each second, to stay within the API's rate limits.
+WBM_CACHE = 'wbm_results.json'  # Results of lookups, kept in the cache folder between runs.
+WBM_CACHE_DAYS = {WAYBACK_MACHINE: 30,  # Days a lookup is reused before the link is looked up again, by result.
+                  NO_RESPONSE: 7}
 
 
 
 """ ---------- Menu Option Four ---------- """
 
 # File names
-DIFFERENCES = 'differences.csv'
\ No newline at end of file
+DIFFERENCES = 'differences.csv'
+
+# Comparing on disk
+DIFF_ENGINE = 'auto'                 # 'memory' imports both files, 'disk' copies them into a database in the temporary folder a chunk
+                                     # at a time and compares them there. 'auto' uses disk for files larger than DIFF_MEMORY_LIMIT.
+DIFF_MEMORY_LIMIT = 1024 * 1024 * 1024  # Combined size (bytes) of both files above which they are compared on disk.
+DIFF_CHUNK_ROWS = 100000             # Number of rows read from a file, or written to results, at a time when comparing on disk.
+
+# Snapshots. Fingerprints of each version of a file, kept in a folder for each configuration in the snapshots folder.
+CHANGES = 'changes.csv'  # Records added, removed or changed since the last snapshot.
+SNAPSHOTS_KEPT = 10      # Number of snapshots kept for each configuration, older snapshots are removed.
+
+
+""" ------------ Batch Runner ------------ """
+
+# File names
+BATCH_REPORT = 'batch_report.json'  # Result of every job in a batch, saved in the output folder.
+BATCH_LOG = 'job.log'               # Everything printed by a job, saved in the job's output folder.
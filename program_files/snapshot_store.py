@@ -0,0 +1,108 @@
+"""
+Snapshot Store:
+
+Keeps a snapshot of every version of a file, so that a new extract can be compared with the last one without keeping
+(or importing) the old file. A snapshot only holds fingerprints of each record: its id, a hash of the whole row and a
+hash of each column observed for differences. Records are then added, removed or changed depending on whether their
+ids are in both snapshots and whether their hashes match.
+
+Snapshots are kept as Parquet files in a folder for each configuration in the snapshots folder, with the file they were
+taken from (path, size and modification time), so an extract that has already been snapshotted isn't saved again.
+"""
+
+import os
+import json
+import time
+import pandas as pd
+import pyarrow
+import pyarrow.parquet as parquet
+
+from pandas import DataFrame
+from program_files.helpers import error
+from program_files.data_loader import load_chunks
+from program_files.file_profiler import cache_key, file_stamp
+from program_files.settings import DATA_PATH, DIFF_CHUNK_ROWS, SNAPSHOT_PATH, SNAPSHOTS_KEPT
+
+# Prefix of the names of column hashes, so they can't clash with the id and row hashes.
+COLUMN = 'column:'
+
+
+class SnapshotStore():
+    def __init__(self, conf) -> None:
+        """ Opens the snapshots of a configuration's file. """
+
+        self.path = DATA_PATH + SNAPSHOT_PATH + conf.folder_name + '/'
+        self.source = {'file': cache_key(conf.path), 'stamp': file_stamp(conf.path)}
+
+    def names(self) -> list:
+        """ Returns file names of every snapshot, oldest first. """
+
+        if not os.path.exists(self.path):
+            return []
+
+        return sorted(name for name in os.listdir(self.path) if name.endswith('.parquet'))
+
+    def previous(self):
+        """ Returns fingerprints of the latest snapshot taken from a different version of the file, or None if there
+            isn't one. Also returns whether the current version has been snapshotted already. """
+
+        names = self.names()
+        saved = False
+
+        # Only the schema of each snapshot is read to find its source, the snapshot itself is only read if it is returned.
+        for name in reversed(names):
+            if json.loads(parquet.read_schema(self.path + name).metadata[b'source']) == self.source:
+                saved = True
+                continue
+
+            table = parquet.read_table(self.path + name)
+            return (table.to_pandas(types_mapper={pyarrow.string(): pd.StringDtype('pyarrow')}.get), saved)
+
+        return (None, saved)
+
+    def save(self, fingerprints: DataFrame) -> str:
+        """ Saves fingerprints of the current version of the file, removing the oldest snapshots beyond SNAPSHOTS_KEPT.
+            Returns the path of the snapshot. """
+
+        os.makedirs(self.path, exist_ok=True)
+
+        # Names sort in the order snapshots were taken. Nanoseconds keep snapshots taken in the same second apart, and
+        # the process id those taken at the same time by different batch jobs.
+        now = time.time_ns()
+        path = self.path + time.strftime('%Y%m%d-%H%M%S', time.localtime(now // 10 ** 9)) + '-' + str(now % 10 ** 9).zfill(9) + '-' + str(os.getpid()) + '.parquet'
+
+        table = pyarrow.Table.from_pandas(fingerprints, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'source': json.dumps(self.source).encode()})
+
+        # Written to a temporary file first so a partially written snapshot is never read.
+        temp_path = path + '.' + str(os.getpid()) + '.tmp'
+        parquet.write_table(table, temp_path)
+        os.replace(temp_path, path)
+
+        for name in self.names()[:-SNAPSHOTS_KEPT]:
+            os.remove(self.path + name)
+
+        return path
+
+
+def fingerprint(conf) -> DataFrame:
+    """ Returns the id, row hash and a hash of each diff column of every record of a configuration's file. The file is
+        read a chunk of rows at a time, so only the fingerprints are kept in memory. """
+
+    chunks = []
+
+    for chunk in load_chunks(conf, DIFF_CHUNK_ROWS):
+        for column in [conf.id_column] + conf.diff_columns:
+            if column not in chunk.columns:
+                error('Could not find \'' + str(column) + '\' column in ' + conf.folder_name + ' data. ' +
+                      'Have you entered it correctly in the configuration file?')
+
+        fingerprints = {'id': chunk[conf.id_column].reset_index(drop=True),
+                        'row': pd.util.hash_pandas_object(chunk, index=False).to_numpy()}
+
+        for column in conf.diff_columns:
+            fingerprints[COLUMN + column] = pd.util.hash_pandas_object(chunk[column], index=False).to_numpy()
+
+        chunks.append(DataFrame(fingerprints))
+
+    return pd.concat(chunks, ignore_index=True)
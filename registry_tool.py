@@ -3,9 +3,13 @@ Registry Tool:
 
 This file creates the data folder (if it doesnt already exist), loads the main menu and calls respective options 
 based on user input. Contains overall exception handling. 
+
+Jobs can also be run without the menu from a manifest, eg. 'python registry_tool.py --batch jobs.yml --workers 4'.
 """
 
 import os
+import sys
+import argparse
 import colorama
 
 from program_files.link_checker import check_links
@@ -13,8 +17,9 @@ from program_files.menu import SingleSelectionMenu
 from program_files.record_matcher import match_records
 from program_files.settings import DATA_PATH, OUTPUT_PATH
 from program_files.duplicate_detector import detect_duplicates
-from program_files.helpers import cleanup_and_exit, info, error
-from program_files.difference_detector import detect_differences
+from program_files.batch_runner import run_batch
+from program_files.helpers import cleanup_and_exit, set_cores, info, error
+from program_files.difference_detector import detect_changes, detect_differences
 
 
 def run_menu() -> None:
@@ -41,6 +46,7 @@ def run_menu() -> None:
                     'Detect duplicates within a single file.',
                     'Verify links in file.',
                     'Check for differences between records with same ID accross two files.',
+                    'Check for changes to records in a file since it was last checked.',
                     'Exit']
 
     # Create menu with above menu options
@@ -61,7 +67,9 @@ def run_menu() -> None:
         check_links()
     elif selection == 4: 
         detect_differences()
-    elif selection == 5:
+    elif selection == 5: 
+        detect_changes()
+    elif selection == 6:
         cleanup_and_exit(prompt=False)
     else: error('Invalid menu option selected', post='\n', pre='\n')
 
@@ -72,6 +80,26 @@ def main() -> None:
     # Initialise colorama, this facilitates [INFO] and [ERROR] messages being different colours. 
     colorama.init(autoreset=True)
 
+    parser = argparse.ArgumentParser(description='Registry Data Tool')
+    parser.add_argument('--batch', metavar='MANIFEST', help='run the jobs in a YAML manifest without the menu')
+    parser.add_argument('--workers', type=int, help='number of jobs to run at the same time (batch only)')
+    parser.add_argument('--cores', type=int, help='number of cores used to score possible matches and duplicates')
+    args = parser.parse_args()
+
+    if args.cores is not None and args.cores < 1:
+        parser.error('--cores must be at least 1')
+
+    if args.workers is not None and args.workers < 1:
+        parser.error('--workers must be at least 1')
+
+    set_cores(args.cores)
+
+    # Run batch of jobs and exit with its status, so that schedulers can tell if any job failed.
+    if args.batch is not None:
+        code = run_batch(args.batch, workers=args.workers, cores=args.cores)
+        colorama.deinit()
+        sys.exit(code)
+
     try:
         # Attempt to run program menu. 
         run_menu()